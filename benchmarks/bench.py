@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+Benchmarks of config parsing, planning and dispensing at scale
+
+Synthetic spaces of 10, 1k and 10k sections are generated with chains of
+_uses and every section interpolating values of earlier ones. For each
+size the suite times get_config, getuses over all sections, sort_sections,
+get_providers and a complete PROVIDE dialogue through SpaceState.dispense
+answered by an in-process simulated shell.
+
+    benchmarks/bench.py                 compare with benchmarks/baseline.json
+    benchmarks/bench.py --save          record a new baseline
+    benchmarks/bench.py --json          machine readable results
+
+Timings are the best of --repeat runs; a comparison fails when anything is
+slower than the baseline by more than --tolerance, and by more than --floor
+milliseconds, so the jitter of sub-millisecond timings goes unnoticed.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import spaces
+from providers import facts
+
+SIZES = (10, 1000, 10000)
+CHAIN_DEPTH = 50
+VARS = 4
+# slowdowns shorter than this (seconds) are noise, whatever the ratio
+FLOOR = 0.005
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "baseline.json")
+
+HOST = facts.SimulatedHost(dict(
+    which=dict(pip="/usr/bin/pip", git="/usr/bin/git"),
+    env=dict(HOME="/home/dev", PATH="/usr/bin:/bin"),
+    pip=dict(("package%d" % i, "1.0") for i in range(500))))
+
+
+def generate_space(size, seed=0):
+    """Config text with size sections in CHAIN_DEPTH long _uses chains;
+    every variable interpolates one of a random earlier section of its
+    chain"""
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(size):
+        chain_start = i - i % CHAIN_DEPTH
+        lines.append("[section %d]" % i)
+        if i % 10 == 9:
+            lines.append("_provider: PipProvider")
+            lines.append("package%d: 1.%d" % (i % 500, i % 3))
+        else:
+            lines.append("_provider: EnvProvider")
+            envs = [ref for ref in range(chain_start, i) if ref % 10 != 9]
+            for var in range(VARS):
+                if envs:
+                    value = "[section %d]:var%d/%d" % (
+                        rnd.choice(envs), rnd.randrange(VARS), var)
+                else:
+                    value = "/base/%d" % var
+                lines.append("var%d: %s" % (var, value))
+        if i % CHAIN_DEPTH:
+            lines.append("_uses: [section %d]" % (i - 1))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def provide(state):
+    """Complete PROVIDE dialogue against the simulated host; commands run"""
+    frames = state.dispense([("PROVIDE", "")])
+    token = frames[0][1]
+    count = 0
+    while frames[1][0] == "SLOT":
+        request = [("SESSION", token)]
+        for name, payload in frames[1:]:
+            if name == "SLOT":
+                slot = payload
+            elif name == "CMD":
+                status, stdout, stderr = HOST.run(payload)
+                request.extend([("SLOT", slot), ("STATUS", str(status)),
+                                ("STDOUT", stdout), ("STDERR", stderr)])
+                count += 1
+        frames = state.dispense(request)
+    assert frames[1][0] == "END", frames
+    return count
+
+
+def best_of(repeat, run, setup=lambda: None):
+    best = None
+    for _ in range(repeat):
+        arg = setup()
+        started = time.time()
+        run(arg)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_size(size, repeat, workdir):
+    path = os.path.join(workdir, "space-%d.cfg" % size)
+    with open(path, "w") as f:
+        f.write(generate_space(size))
+    parsed = lambda: spaces.get_config(path)
+    results = {}
+    results["get_config"] = best_of(repeat, lambda _: parsed())
+    results["getuses"] = best_of(
+        repeat, lambda cfg: [cfg.getuses(s) for s in cfg.sections()], parsed)
+    results["sort_sections"] = best_of(repeat, spaces.sort_sections, parsed)
+    results["get_providers"] = best_of(repeat, spaces.get_providers, parsed)
+    state = spaces.SpaceState(path, plan_cache=None, journal_dir=None)
+    results["dispense"] = best_of(repeat, lambda _: provide(state))
+    return dict(("%s/%d" % (name, size), seconds)
+                for name, seconds in results.iteritems())
+
+
+def run(sizes, repeat):
+    workdir = tempfile.mkdtemp(prefix="spaces-bench-")
+    results = {}
+    try:
+        for size in sizes:
+            results.update(bench_size(size, repeat if size < 10000 else 1,
+                                      workdir))
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def compare(results, baseline, tolerance, floor=FLOOR):
+    """Names of benchmarks slower than baseline by more than tolerance and
+    by more than floor seconds"""
+    return sorted(name for name, seconds in results.iteritems()
+                  if name in baseline and
+                  seconds > baseline[name] * (1 + tolerance) and
+                  seconds - baseline[name] > floor)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true",
+                        help="store results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed slowdown against the baseline "
+                             "(0.5 is 50%%)")
+    parser.add_argument("--floor", type=float, default=FLOOR * 1000,
+                        metavar="MS",
+                        help="slowdowns shorter than this are ignored")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.repeat)
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(dict(python=platform.python_version(),
+                           machine=platform.machine(), results=results),
+                      f, indent=2, sort_keys=True)
+            f.write("\n")
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    except (IOError, ValueError, KeyError):
+        baseline = {}
+    regressions = compare(results, baseline, args.tolerance,
+                          args.floor / 1000.0)
+
+    if args.json:
+        print json.dumps(dict(results=results, baseline=baseline,
+                              regressions=regressions), indent=2,
+                         sort_keys=True)
+    else:
+        for name in sorted(results, key=lambda n: (int(n.split("/")[1]), n)):
+            base = baseline.get(name)
+            print "%-24s %9.4fs %s%s" % (
+                name, results[name],
+                "(baseline %.4fs)" % base if base is not None else "",
+                " SLOWER" if name in regressions else "")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
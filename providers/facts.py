@@ -0,0 +1,274 @@
+"""
+Facts about a host, collected from the probe commands providers yield
+
+Providers ask the shell the same questions over and over: where pip or git
+is, what the environment looks like, which packages are installed. The
+answers are kept here per session so a repeated probe is answered without
+a round trip. Answers expire after a TTL and are dropped as soon as a
+command that may change them (package installs, exports...) goes through.
+The env fact is the environment a session started with: exports done by
+providers do not replace it, as what they back up is what was there before.
+
+Package index refreshes are tracked per host by RefreshLog, shared by all
+sessions of a daemon, so a refresh done by one session is not repeated by
+the next while it is fresh, nor by another one while it is running.
+
+SimulatedHost answers the same probes from a snapshot file instead of a
+shell, for planning without touching any machine.
+"""
+
+import json
+import re
+import threading
+import time
+
+FACTS_TTL = 5 * 60
+# package index younger than this (seconds) is not refreshed
+INDEX_MAX_AGE = 60 * 60
+# a refresh not reported back within this (seconds) is taken as given up
+REFRESH_TIMEOUT = 10 * 60
+
+# probe commands whose results can be reused, with the kind of fact
+PROBES = [
+    (re.compile(r"^which \S+$"), 'which'),
+    (re.compile(r"^env$"), 'env'),
+    (re.compile(r"^\S*pip freeze$"), 'pip'),
+    (re.compile(r"^\S*dpkg-query -W\b"), 'deb'),
+    (re.compile(r"^\S*rpm -qa$"), 'rpm'),
+]
+
+# commands changing the host, with the kinds of facts they invalidate
+MUTATIONS = [
+    (re.compile(r"\bapt-get\b.*\b(install|upgrade|remove|purge)\b"),
+     ('deb', 'which')),
+    (re.compile(r"\byum\b.*\b(install|upgrade|remove|erase)\b"),
+     ('rpm', 'which')),
+    (re.compile(r"\bpip\b.*\b(install|uninstall)\b"), ('pip', 'which')),
+    (re.compile(r"^\s*(export|unset)\b.*\bPATH\b"), ('which', 'pip')),
+    (re.compile(r"^\s*(source|deactivate|\.)\b"), ('env', 'which', 'pip')),
+]
+
+
+# package index refreshes, tracked per host rather than per session
+REFRESHES = re.compile(r"\b(apt-get update|yum makecache)$")
+
+
+def probe_kind(cmd):
+    """Kind of fact cmd probes for, None when it is not a known probe"""
+    for pattern, kind in PROBES:
+        if pattern.match(cmd):
+            return kind
+    return None
+
+
+def invalidated_by(cmd):
+    kinds = set()
+    for pattern, affected in MUTATIONS:
+        if pattern.search(cmd):
+            kinds.update(affected)
+    return kinds
+
+
+class RefreshLog(object):
+    """When package indexes were last refreshed on each host, and which
+    refreshes are running"""
+    def __init__(self, max_age, timeout=REFRESH_TIMEOUT):
+        self.max_age = max_age
+        self.timeout = timeout
+        self._refreshed = {}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def claim(self, host, cmd):
+        """Whether the caller is to run refresh cmd on host: the index is
+        not fresh and nobody is refreshing it already (those who are not
+        go on with the index as it is)"""
+        key, now = (host, cmd), time.time()
+        with self._lock:
+            refreshed = self._refreshed.get(key)
+            if refreshed is not None and now - refreshed < self.max_age:
+                return False
+            started = self._running.get(key)
+            if started is not None and now - started < self.timeout:
+                return False
+            self._running[key] = now
+            return True
+
+    def record(self, host, cmd, succeeded=True):
+        """A claimed refresh is over"""
+        with self._lock:
+            self._running.pop((host, cmd), None)
+            if succeeded:
+                self._refreshed[(host, cmd)] = time.time()
+
+
+class HostFacts(object):
+    """Probe results of one host, answered from memory while fresh"""
+    def __init__(self, ttl=FACTS_TTL, host="localhost", refresh_log=None):
+        self.ttl = ttl
+        self.host = host
+        self.refresh_log = refresh_log
+        self._facts = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _is_refresh(self, cmd):
+        return self.refresh_log is not None and REFRESHES.search(cmd)
+
+    def lookup(self, cmd):
+        """Cached (status, stdout, stderr) of cmd, or None"""
+        if self._is_refresh(cmd):
+            if self.refresh_log.claim(self.host, cmd):
+                return None
+            self.hits += 1
+            return (0, "", "")
+        try:
+            kind, recorded, result = self._facts[cmd]
+        except KeyError:
+            if probe_kind(cmd) is not None:
+                self.misses += 1
+            return None
+        if time.time() - recorded > self.ttl:
+            del self._facts[cmd]
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def observe(self, cmd, result):
+        """Learn from a command that went through the shell"""
+        kinds = invalidated_by(cmd)
+        if kinds:
+            self.invalidate(*kinds)
+        if self._is_refresh(cmd):
+            self.refresh_log.record(self.host, cmd, result[0] == 0)
+        kind = probe_kind(cmd)
+        if kind is not None:
+            self._facts[cmd] = (kind, time.time(), result)
+
+    def invalidate(self, *kinds):
+        """Forget facts of the given kinds, or all of them"""
+        if not kinds:
+            self._facts.clear()
+            return
+        for cmd in [cmd for cmd, fact in self._facts.iteritems()
+                    if fact[0] in kinds]:
+            del self._facts[cmd]
+
+    def close(self):
+        """Forget every fact, closing the streamed outputs they hold"""
+        for _, _, result in self._facts.itervalues():
+            for output in result[1:]:
+                if hasattr(output, 'close'):
+                    output.close()
+        self._facts.clear()
+
+
+class SimulatedHost(object):
+    """Answers commands from a snapshot of a host's facts
+
+    The snapshot is a dict (usually loaded from JSON) with optional keys:
+        which: tool name -> path
+        paths: existing files and directories (for test -d/-f/-e)
+        env: environment variables
+        pip, deb, rpm: installed package name -> version
+        commands: exact command -> [status, stdout, stderr]
+        default: [status, stdout, stderr] for any other command
+    """
+    _TEST_PATH = re.compile(r"^test -[dfe] (\S+)$")
+    _TEST_EMPTY = re.compile(r"^test -z \"\$(\w+)\"$")
+    _PACKAGE_FORMATS = {'pip': "%s==%s", 'deb': "%s==%s", 'rpm': "%s-%s"}
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.default = tuple(snapshot.get('default', (0, "", "")))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def _packages(self, kind):
+        fmt = self._PACKAGE_FORMATS[kind]
+        return (0, "\n".join(fmt % item for item in
+                             sorted(self.snapshot.get(kind, {}).items())), "")
+
+    def run(self, cmd):
+        """(status, stdout, stderr) the host would answer cmd with"""
+        if cmd in self.snapshot.get('commands', {}):
+            return tuple(self.snapshot['commands'][cmd])
+        kind = probe_kind(cmd)
+        if kind == 'which':
+            path = self.snapshot.get('which', {}).get(cmd.split()[1])
+            return (0, path, "") if path else (1, "", "")
+        if kind == 'env':
+            return (0, "\n".join("%s=%s" % item for item in
+                                 sorted(self.snapshot.get('env', {}).items())),
+                    "")
+        if kind is not None:
+            return self._packages(kind)
+        match = self._TEST_PATH.match(cmd)
+        if match:
+            return (0 if match.group(1) in self.snapshot.get('paths', ())
+                    else 1, "", "")
+        match = self._TEST_EMPTY.match(cmd)
+        if match:
+            return (1 if self.snapshot.get('env', {}).get(match.group(1))
+                    else 0, "", "")
+        return self.default
+
+
+if __name__ == "__main__":
+    facts = HostFacts()
+    assert facts.lookup("which pip") is None
+    facts.observe("which pip", (0, "/usr/bin/pip", ""))
+    facts.observe("/usr/bin/pip freeze", (0, "ipython==1.1.0", ""))
+    facts.observe("test -d ~/spaces", (1, "", ""))
+    assert (0, "/usr/bin/pip", "") == facts.lookup("which pip")
+    assert facts.lookup("test -d ~/spaces") is None
+    facts.observe("/usr/bin/pip install -U ipython==1.2.0", (0, "", ""))
+    assert facts.lookup("/usr/bin/pip freeze") is None
+    assert facts.lookup("which pip") is None
+    facts.observe("which git", (0, "/usr/bin/git", ""))
+    facts.observe("env", (0, "HOME=/home/dev", ""))
+    facts.observe("export WORKSPACE=~/ws && export SRC=$WORKSPACE/src",
+                  (0, "", ""))
+    assert (0, "/usr/bin/git", "") == facts.lookup("which git")
+    assert (0, "HOME=/home/dev", "") == facts.lookup("env")
+    facts.observe("source ~/ws/venv/bin/activate", (0, "", ""))
+    assert facts.lookup("which git") is None
+    facts.observe("which git", (0, "/usr/bin/git", ""))
+    facts.ttl = -1
+    assert facts.lookup("which git") is None
+    facts.ttl = FACTS_TTL
+    facts.observe("which git", (0, "/usr/bin/git", ""))
+    facts.close()
+    assert facts.lookup("which git") is None
+
+    refreshes = RefreshLog(max_age=60)
+    first = HostFacts(refresh_log=refreshes)
+    second = HostFacts(refresh_log=refreshes)
+    assert first.lookup("sudo /usr/bin/apt-get update") is None
+    first.observe("sudo /usr/bin/apt-get update", (0, "", ""))
+    assert (0, "", "") == second.lookup("sudo /usr/bin/apt-get update")
+    other = HostFacts(host="runner-2", refresh_log=refreshes)
+    assert other.lookup("sudo /usr/bin/apt-get update") is None
+    # while one session refreshes, another goes on without
+    third = HostFacts(host="runner-2", refresh_log=refreshes)
+    assert (0, "", "") == third.lookup("sudo /usr/bin/apt-get update")
+    other.observe("sudo /usr/bin/apt-get update", (100, "", "failed"))
+    assert third.lookup("sudo /usr/bin/apt-get update") is None
+    refreshes.timeout = -1
+    assert other.lookup("sudo /usr/bin/apt-get update") is None
+
+    host = SimulatedHost(dict(which=dict(pip="/usr/bin/pip"),
+                              paths=["~/spaces"], env=dict(HOME="/home/dev"),
+                              rpm=dict(wget="1.0.1", foo="1.1.1"),
+                              commands={"make": [2, "", "no rule"]}))
+    assert (0, "/usr/bin/pip", "") == host.run("which pip")
+    assert 1 == host.run("which git")[0]
+    assert 0 == host.run("test -d ~/spaces")[0]
+    assert 1 == host.run("test -f ~/env/bin/activate")[0]
+    assert 0 == host.run('test -z "$VIRTUAL_ENV"')[0]
+    assert (0, "foo-1.1.1\nwget-1.0.1", "") == host.run("/usr/bin/rpm -qa")
+    assert (2, "", "no rule") == host.run("make")
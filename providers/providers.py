@@ -13,11 +13,39 @@ depending on the checks result (4) may be called to clean up
 
 Providers shouldn't rely on doing own tests of state as their output once
 generated needs to be self-sufficient.
+
+A provider generator yields either a single command and gets back its
+(status, stdout, stderr), or a list of independent commands which are run
+in one round trip and answered with the list of their results.
+
+Outputs are strings, except large ones which come as iterables of lines
+(see spaces_protocol.protocol.Output); lines() reads either.
+
+Providers whose work outlives the shell (installed packages, checkouts)
+set persistent; once applied to a host such a section is skipped until it
+changes or re-application is forced. The others run every time.
+
+Providers whose revert() needs what provide() found keep it in a backup
+dict of plain values, for --exec runs to store between runs.
 """
 
+import hashlib
 import os
 import platform
-import ipdb
+import re
+import toposort
+
+import facts
+
+
+_DISTRIBUTION = {}
+
+
+def distribution():
+    """Lowercase name of the Linux distribution, looked up once"""
+    if 'name' not in _DISTRIBUTION:
+        _DISTRIBUTION['name'] = platform.dist()[0].lower()
+    return _DISTRIBUTION['name']
 
 
 class StopTheLine(Exception):
@@ -25,78 +53,165 @@ class StopTheLine(Exception):
     pass
 
 
+def lines(output):
+    """Lines of a command output, lazily when it is streamed"""
+    if isinstance(output, basestring):
+        return output.splitlines()
+    return output
+
+
 class EnvProvider(object):
-    """Provide setting and exporting environment variables"""
+    """Provide setting and exporting environment variables
+
+    Variables referring to others of the section ($NAME or ${NAME}) are
+    exported after them; all exports go out as a single command.
+    """
 
     append_only = []
+    _REFERENCE = re.compile(r"\$\{?(\w+)")
 
     def __init__(self, params):
         self._env_vars = params.copy()
-        self._backup = {}
+        self.backup = {}
 
     def _save_current_vars(self, stdout):
-        if isinstance(stdout, str):
-            lines = stdout.split("\n")
-        else:
-            lines = stdout
-        for line in lines:
+        for line in lines(stdout):
             try:
                 name, value = line.split("=", 1)
                 if name in self._env_vars:
-                    self._backup[name] = value
+                    self.backup[name] = value
             except ValueError:
                 pass
 
 
+    def _get_export_order(self):
+        """Variable names, the ones referred to by others first"""
+        # the shell tells $WORKSPACE from an exported workspace, so only
+        # references with the very name of a variable count
+        graph = {}
+        for name, value in self._env_vars.iteritems():
+            # a variable extending itself (PATH=$PATH:...) uses the old value
+            graph[name] = set(ref for ref in
+                              self._REFERENCE.findall(str(value))
+                              if ref in self._env_vars and ref != name)
+        try:
+            return toposort.toposort_flatten(graph)
+        except toposort.CircularDependencyError as e:
+            raise StopTheLine("Variables refer to each other: %s" % ", ".join(
+                sorted(e.data)))
+
     def _get_export_commands(self):
-        names = self._env_vars.keys()
-        # ensure variables having other baked in go to the end of queue
-        names.sort(cmp=lambda x, y: -1 if x in self._env_vars[y] else 0)
         return ["export %s=%s" % (name, self._env_vars[name])
-                for name in names]
+                for name in self._get_export_order()]
 
     def provide(self):
         """Set environment variables (back up existing)"""
+        commands = self._get_export_commands()
         _, stdout, _ = yield "env"
         self._save_current_vars(stdout)
-        for cmd in self._get_export_commands():
-            yield cmd
+        if commands:
+            yield " && ".join(commands)
 
     def revert(self):
         """Restore environment variables"""
-        for var, val in self._backup.iteritems():
-            yield "export %s=%s" % (var, val)
-        if self._backup:
-            backup_keys = self._backup.keys()
-            to_unset = [var for var in self._env_vars.keys()
-                        if var not in backup_keys]
-            if to_unset:
-                yield "unset %s" % " ".join(to_unset)
-        else:
-            if self._env_vars:
-                yield "unset %s" % " ".join(self._env_vars.keys())
+        commands = ["export %s=%s" % (var, self.backup[var])
+                    for var in sorted(self.backup)]
+        to_unset = sorted(var for var in self._env_vars
+                          if var not in self.backup)
+        if to_unset:
+            commands.append("unset %s" % " ".join(to_unset))
+        if commands:
+            yield " && ".join(commands)
 
 
 class VirtualenvProvider(object):
-    """Provide virtualenv"""
+    """Provide virtualenv
+
+    Optional params:
+        cache: directory of prebuilt environments; a missing virtualenv is
+               copied from there when one was built for the same
+               interpreter and requirements, otherwise it is built with
+               its requirements installed and stored there
+        cache_size: MB the cache is kept under, least recently used
+                    environments are evicted first
+        requirements: packages (name==version) to build cached
+                      environments with; the planner adds the ones of the
+                      PipProvider sections using this one (_requirements)
+    """
+
+    _INTERPRETER = "python -c 'import sys; print(sys.version)'"
+    # run in subshells so that nothing leaks into the user's shell;
+    # virtualenvs are not relocatable, absolute paths get rewritten
+    _RESTORE = ('(src=$(cd %(entry)s && pwd) && mkdir -p %(path)s && '
+                'cp -a "$src/." %(path)s && dst=$(cd %(path)s && pwd) && '
+                '{ grep -rlIF "$src" "$dst/bin" | '
+                'xargs -r sed -i "s#$src#$dst#g"; } && touch "$src")')
+    _STORE = ('(mkdir -p %(cache)s && src=$(cd %(path)s && pwd) && '
+              'tmp=$(mktemp -d %(cache)s/.tmp.XXXXXX) && '
+              'cp -a "$src/." "$tmp" && dst=$(cd %(cache)s && pwd)/%(key)s && '
+              '{ grep -rlIF "$src" "$tmp/bin" | '
+              'xargs -r sed -i "s#$src#$dst#g"; } && '
+              '{ mv -T "$tmp" "$dst" || rm -rf "$tmp"; } && touch "$dst" && '
+              'cd %(cache)s && '
+              'while [ "$(du -sk . | cut -f1)" -gt %(size)d ] && '
+              '[ "$(ls | wc -l)" -gt 1 ]; do rm -rf "$(ls -t | tail -n 1)"; '
+              'done)')
+
     def __init__(self, params):
         self.path = params['path']
+        self.cache = params.get('cache')
+        self.cache_size = int(params.get('cache_size', 4096))
+        requirements = set(params.get('_requirements', ()))
+        own = params.get('requirements', ())
+        for requirement in [own] if isinstance(own, basestring) else own:
+            requirements.update(requirement.split())
+        self.requirements = sorted(requirements)
+
+    def _cache_key(self, interpreter):
+        digest = hashlib.sha1()
+        digest.update("\n".join([str(interpreter)] + self.requirements))
+        return digest.hexdigest()
 
     def provide(self):
         """Set up and activate virtualenv"""
-        rcode, stdout, _ = yield "which virtualenv"
-        if rcode != 0:
-            raise StopTheLine("Virtualenv is not installed")
-        virtualenv = stdout
         activate_path = '%s/bin/activate' % self.path
-        rcode, _, _ = yield "test -f %s" % activate_path
+        probes = ["which virtualenv", "test -f %s" % activate_path,
+                  'test -z "$VIRTUAL_ENV"']
+        if self.cache:
+            probes.append(self._INTERPRETER)
+        results = yield probes
+        (rcode, virtualenv, _), (exists, _, _), (active, _, _) = results[:3]
         if rcode != 0:
+            raise StopTheLine("Virtualenv is not installed")
+        if exists != 0 and self.cache:
+            key = self._cache_key(results[3][1])
+            entry = "%s/%s" % (self.cache, key)
+            cached, _, _ = yield "test -d %s" % entry
+            if cached == 0:
+                rcode, _, _ = yield self._RESTORE % dict(entry=entry,
+                                                         path=self.path)
+                if rcode != 0:
+                    raise StopTheLine("Restoring virtualenv from %s failed"
+                                      % entry)
+            else:
+                rcode, _, _ = yield "%s %s" % (virtualenv, self.path)
+                if rcode != 0:
+                    raise StopTheLine("Virtualenv setup failed")
+                if self.requirements:
+                    rcode, _, _ = yield "%s/bin/pip install %s" % (
+                        self.path, " ".join(self.requirements))
+                    if rcode != 0:
+                        raise StopTheLine("Installing %s failed" %
+                                          " ".join(self.requirements))
+                # a failure to store only costs the next build
+                yield self._STORE % dict(cache=self.cache, path=self.path,
+                                         key=key, size=self.cache_size * 1024)
+        elif exists != 0:
             rcode, _, _ = yield "%s %s" % (virtualenv, self.path)
             if rcode != 0:
                 raise StopTheLine("Virtualenv setup failed")
-        # we have env set up
-        rcode, _, _ = yield 'test -z "$VIRTUAL_ENV"'
-        if rcode != 0:
+        # we have env set up; test -z passes when none is active yet
+        if active == 0:
             yield "source %s" % activate_path
 
     def revert(self):
@@ -108,10 +223,45 @@ class VirtualenvProvider(object):
 
 class PkgProvider(object):
     """Base class for package handling"""
+
+    persistent = True
+
+    # package -> sections it was asked for in, set when the planner merged
+    # several sections into one provider
+    origins = None
+
+    # package index younger than this (seconds) is not refreshed,
+    # facts.INDEX_MAX_AGE unless set
+    index_max_age = None
+    index_path = None
+    # find test picking what under index_path tells the index age
+    index_find = "-maxdepth 0"
+
     def __init__(self, params):
         self._packages = params
         self._backup = {}
 
+    def _failure(self, message):
+        if not self.origins:
+            return StopTheLine(message)
+        by_section = {}
+        for package, sections in self.origins.iteritems():
+            for section in sections:
+                by_section.setdefault(section, []).append(package)
+        return StopTheLine("%s (%s)" % (message, "; ".join(
+            "[%s]: %s" % (section, " ".join(sorted(packages)))
+            for section, packages in sorted(by_section.iteritems()))))
+
+    def _parse_installed(self, output, separator):
+        """Installed versions of the requested packages, from a listing
+        of name<separator>version lines read one at a time"""
+        installed = {}
+        for line in lines(output):
+            name, found, version = line.strip().rpartition(separator)
+            if found and name in self._packages:
+                installed[name] = version
+        return installed
+
     def _get_upgrades_and_installs(self, installed, ver_mark):
         to_install = []
         to_upgrade = []
@@ -128,21 +278,32 @@ class PkgProvider(object):
         return to_install, to_upgrade
 
     concrete_implementations = set()
+    _implementation = None
 
     def __new__(cls, params):
         if cls is PkgProvider:
-            candidates = [provider for provider in cls.concrete_implementations
-                          if provider.compatible_platform()]
-            if len(candidates) < 1:
-                raise RuntimeError("No concrete implementation available")
-            if len(candidates) > 1:
-                raise RuntimeError(
-                    "More than one concrete implementation available")
+            if PkgProvider._implementation is None:
+                candidates = [provider for provider
+                              in cls.concrete_implementations
+                              if provider.compatible_platform()]
+                if len(candidates) < 1:
+                    raise RuntimeError("No concrete implementation available")
+                if len(candidates) > 1:
+                    raise RuntimeError(
+                        "More than one concrete implementation available")
+                PkgProvider._implementation = candidates[0]
             return super(PkgProvider, cls).__new__(
-                    candidates[0], params)
+                    PkgProvider._implementation, params)
         else:
             return super(PkgProvider, cls).__new__(cls, params)
 
+    def _index_fresh_check(self):
+        """Command succeeding when the package index is younger than
+        index_max_age"""
+        max_age = self.index_max_age or facts.INDEX_MAX_AGE
+        return 'test -n "$(find %s %s -mmin -%d 2>/dev/null)"' % (
+            self.index_path, self.index_find, max(1, max_age // 60))
+
 
 class PipProvider(PkgProvider):
     """Provides python packages installed with pip"""
@@ -151,11 +312,8 @@ class PipProvider(PkgProvider):
         if rcode != 0:
             raise StopTheLine("Pip is not installed")
         pip = stdout
-        installed = {}
         _, stdout, _ = yield "%s freeze" % pip
-        for line in stdout.split("\n"):
-            name, version = line.split("==")
-            installed[name] = version
+        installed = self._parse_installed(stdout, "==")
 
         to_install, to_upgrade = self._get_upgrades_and_installs(
                 installed, '==')
@@ -164,45 +322,50 @@ class PipProvider(PkgProvider):
             rcode, _, _ = yield " ".join(
                     ["%s install" % pip] + to_install)
             if rcode != 0:
-                raise StopTheLine("Installing packages failed")
+                raise self._failure("Installing packages failed")
         else:
-            raise StopTheLine("Upgrading packages failed")
+            raise self._failure("Upgrading packages failed")
 
 
 class DebPkgProvider(PkgProvider):
     """Provides deb packages' installations"""
+
+    index_path = "/var/lib/apt/lists"
+
     def provide(self):
-        rcode, apt, _ = yield "which apt-get"
+        (rcode, apt, _), (dpkg_rcode, dpkg_query, _), (stale, _, _) = yield [
+            "which apt-get", "which dpkg-query", self._index_fresh_check()]
         if rcode != 0:
             raise StopTheLine("apt-get not available")
-        rcode, dpkg_query, _ = yield "which dpkg-query"
-        if rcode != 0:
+        if dpkg_rcode != 0:
             raise StopTheLine("dpkg-query not available")
         cmd = "%s -W --showformat='${Package}==${Version}\n'" % dpkg_query
         _, stdout, _ = yield cmd
 
-        installed = {}
-        for line in stdout.strip().split("\n"):
-            name, version = line.split("==")
-            installed[name] = version
+        installed = self._parse_installed(stdout, "==")
         to_install, to_upgrade = self._get_upgrades_and_installs(
                 installed, '=')
+        if not (to_install or to_upgrade):
+            return
 
-        rcode, _, _ = yield "sudo %s update" % apt
-        if rcode != 0:
-            raise StopTheLine("Failed to update apt-get cache")
+        if stale:
+            rcode, _, _ = yield "sudo %s update" % apt
+            if rcode != 0:
+                raise StopTheLine("Failed to update apt-get cache")
         if to_upgrade:
             rcode, _, _ = yield " ".join(
                 ["sudo %s upgrade" % apt] + to_upgrade)
         if rcode != 0:
-            raise StopTheLine("Debian packages installation failed")
+            raise self._failure("Debian packages installation failed")
         if to_install:
             rcode, _, _ = yield " ".join(
                     ["sudo %s install" % apt] + to_install)
+            if rcode != 0:
+                raise self._failure("Debian packages installation failed")
 
     @staticmethod
     def compatible_platform():
-        return platform.dist()[0].lower() == 'debian'
+        return distribution() == 'debian'
 
 PkgProvider.concrete_implementations.add(DebPkgProvider)
 
@@ -210,42 +373,67 @@ PkgProvider.concrete_implementations.add(DebPkgProvider)
 class RpmPkgProvider(PkgProvider):
     """Provides rpm packages' installations"""
 
+    index_path = "/var/cache/yum"
+    # the top directory is not touched by makecache, repository metadata is
+    index_find = "-name repomd.xml"
+
     def provide(self):
         """Install and upgrade rpm packages"""
-        rcode, rpm, _ = yield "which rpm"
+        (rcode, rpm, _), (yum_rcode, yum, _), (stale, _, _) = yield [
+            "which rpm", "which yum", self._index_fresh_check()]
         if rcode != 0:
             raise StopTheLine("rpm not available")
-        rcode, yum, _ = yield "which yum"
-        if rcode != 0:
+        if yum_rcode != 0:
             raise StopTheLine("yum not available")
         _, stdout, _ = yield "%s -qa" % rpm
-        installed = {}
-        for line in stdout.strip().split("\n"):
-            name, version = line.split("-")
-            installed[name] = version
+        installed = self._parse_installed(stdout, "-")
         to_install, to_upgrade = self._get_upgrades_and_installs(
                 installed, '-')
-        rcode, _, _ = yield "sudo %s makecache" % yum
-        if rcode != 0:
-            raise StopTheLine("Failed to update yum cache")
+        if not (to_install or to_upgrade):
+            return
+        if stale:
+            rcode, _, _ = yield "sudo %s makecache" % yum
+            if rcode != 0:
+                raise StopTheLine("Failed to update yum cache")
         if to_upgrade:
             rcode, _, _ = yield " ".join(
                 ["sudo %s upgrade -y" % yum] + to_upgrade)
         if rcode != 0:
-            raise StopTheLine("RPM packages' installation failed")
+            raise self._failure("RPM packages' installation failed")
         if to_install:
             rcode, _, _ = yield " ".join(
                     ["sudo %s install -y" % yum] + to_install)
+            if rcode != 0:
+                raise self._failure("RPM packages' installation failed")
 
     @staticmethod
     def compatible_platform():
-        return platform.dist()[0].lower() == 'redhat'
+        return distribution() == 'redhat'
 
 
 class GitProvider(object):
+    """Provide git repository checkouts
+
+    Optional params:
+        depth: shallow clone with that many commits
+        filter: partial clone filter, e.g. blob:none
+        mirror: directory of local bare mirrors; the mirror of origin is
+                created or fetched there and the clone borrows its objects
+        update: (yes/no) fast-forward an existing checkout instead of
+                stopping the line; once the section is applied that takes
+                a forced provide
+    """
+
+    persistent = True
+    _TRUE = ('yes', 'true', 'on', '1')
+
     def __init__(self, params):
         self.path = params['path']
         self.origin = params['origin']
+        self.depth = params.get('depth')
+        self.filter = params.get('filter')
+        self.mirror = params.get('mirror')
+        self.update = str(params.get('update', 'no')).lower() in self._TRUE
         self.ignore = []  # private ignore, goes to .git/info/exclude
         for ignore in params.get('ignore', []):
             if ignore.startswith(self.path):
@@ -253,21 +441,55 @@ class GitProvider(object):
             else:
                 self.ignore.append(ignore)
 
+    @property
+    def mirror_path(self):
+        name = re.sub(r"[^\w.-]+", "_", self.origin).strip("_")
+        return os.path.join(self.mirror, "%s.git" % name)
+
+    def _clone_options(self):
+        options = []
+        if self.depth:
+            options.append("--depth %s" % self.depth)
+        if self.filter:
+            options.append("--filter=%s" % self.filter)
+        if self.mirror:
+            options.append("--reference %s --dissociate" % self.mirror_path)
+        return "".join(" %s" % option for option in options)
+
     def provide(self):
-        rcode, git, _ = yield "which git"
+        """Clone or update git repository"""
+        probes = ["which git", "test -d %s" % self.path]
+        if self.mirror:
+            probes.append("test -d %s" % self.mirror_path)
+        results = yield probes
+        (rcode, git, _), (exists, _, _) = results[:2]
         if rcode != 0:
             raise StopTheLine("Git is not installed")
-
-        rcode, _, _ = yield "test -d %s" % self.path
-        if rcode == 0:
-            raise StopTheLine("Directory already exists")
-        rcode, _, _ = yield "%s clone %s %s" % (git, self.origin, self.path)
+        if exists == 0:
+            if not self.update:
+                raise StopTheLine("Directory already exists")
+            rcode, _, _ = yield "%s -C %s pull --ff-only" % (git, self.path)
+            if rcode != 0:
+                raise StopTheLine("Cannot update repo")
+            return
+        if self.mirror:
+            if results[2][0] == 0:
+                cmd = "%s --git-dir=%s fetch --prune" % (git, self.mirror_path)
+            else:
+                cmd = "%s clone --mirror %s %s" % (
+                    git, self.origin, self.mirror_path)
+            rcode, _, _ = yield cmd
+            if rcode != 0:
+                raise StopTheLine("Cannot update mirror of %s" % self.origin)
+        rcode, _, _ = yield "%s clone%s %s %s" % (
+            git, self._clone_options(), self.origin, self.path)
         if rcode != 0:
             raise StopTheLine("Cannot clone repo")
-        # ignore
-        exclude_path = os.path.join(self.path, ".git/info/exclude")
-        ignore = "\n".join(self.ignore)
-        _, _, _ = yield "cat >>%s <<EOF%s\nEOF" % (exclude_path, ignore)
+        # ignore; quoted, the patterns are not expanded
+        if self.ignore:
+            exclude_path = os.path.join(self.path, ".git/info/exclude")
+            _, _, _ = yield "cat >>%s <<'EOF'\n%s\nEOF" % (
+                exclude_path, "\n".join(self.ignore))
 
 
 if __name__ == "__main__":
@@ -275,28 +497,74 @@ if __name__ == "__main__":
     result = env_provider.provide()
     assert "env" == result.next()
     stdout = "SHELL=/bin/bash\nUSER=jks\nTMP=/another"
-    assert "export TMP=/tmp" == result.send((0, stdout, ""))
-    assert "export A=$TMP/blah" == result.send((0, "", ""))
+    assert "export TMP=/tmp && export A=$TMP/blah" == result.send(
+            (0, stdout, ""))
     try:
         result.send((0, "", ""))
+        assert False
     except StopIteration as e:
-        assert True
+        pass
     result = env_provider.revert()
-    assert "export TMP=/another" == result.next()
-    assert "unset A" == result.next()
+    assert "export TMP=/another && unset A" == result.next()
+
+    env_provider = EnvProvider(params=dict(
+        C='${B}/c', B='$A/b', A='/a', PATH='$PATH:$C', D='/d'))
+    assert ['A', 'D', 'B', 'C', 'PATH'] == env_provider._get_export_order()
+    env_provider = EnvProvider(params=dict(
+        pythonpath='$workspace/src:$PYTHONPATH', workspace='/ws',
+        home='$HOME', ws='$WORKSPACE'))
+    assert ['home', 'workspace', 'ws', 'pythonpath'] == \
+        env_provider._get_export_order()
+    # names in another case are other variables, not a cycle
+    env_provider = EnvProvider(params=dict(a='$B', b='$A'))
+    assert ['a', 'b'] == env_provider._get_export_order()
+    env_provider = EnvProvider(params=dict(A='$B', B='${A}x'))
+    try:
+        env_provider.provide().next()
+        assert False
+    except StopTheLine as e:
+        assert "A, B" in str(e)
 
     venv_provider = VirtualenvProvider(params=dict(path='~/env'))
     result = venv_provider.provide()
-    assert "which virtualenv" == result.next()
-    assert "test -f ~/env/bin/activate" == result.send(
-            (0, "/usr/local/bin/virtualenv", ""))
-    assert "/usr/local/bin/virtualenv ~/env" == result.send((1, "", ""))
-    assert "test -z \"$VIRTUAL_ENV\"" == result.send((0, "", ""))
-    assert "source ~/env/bin/activate" == result.send((1, "", ""))
+    assert ["which virtualenv", "test -f ~/env/bin/activate",
+            "test -z \"$VIRTUAL_ENV\""] == result.next()
+    cmd = result.send([(0, "/usr/local/bin/virtualenv", ""), (1, "", ""),
+                       (0, "", "")])
+    assert "/usr/local/bin/virtualenv ~/env" == cmd
+    assert "source ~/env/bin/activate" == result.send((0, "", ""))
     try:
         result.send((0, "", ""))
     except StopIteration as e:
         pass
+    venv_provider = VirtualenvProvider(params=dict(
+        path='~/env', cache='~/.spaces/venvs', requirements='nose==1.3 six'))
+    result = venv_provider.provide()
+    assert VirtualenvProvider._INTERPRETER == result.next()[3]
+    interpreter = (0, "2.7.18 (default)", "")
+    key = venv_provider._cache_key(interpreter[1])
+    cmd = result.send([(0, "/usr/local/bin/virtualenv", ""), (1, "", ""),
+                       (0, "", ""), interpreter])
+    assert "test -d ~/.spaces/venvs/%s" % key == cmd
+    assert result.send((0, "", "")).startswith(
+        "(src=$(cd ~/.spaces/venvs/%s && pwd)" % key)
+    assert "source ~/env/bin/activate" == result.send((0, "", ""))
+    result = venv_provider.provide()
+    result.next()
+    # already active: built and stored, not sourced again
+    result.send([(0, "/usr/local/bin/virtualenv", ""), (1, "", ""),
+                 (1, "", ""), interpreter])
+    assert "/usr/local/bin/virtualenv ~/env" == result.send((1, "", ""))
+    assert "~/env/bin/pip install nose==1.3 six" == result.send((0, "", ""))
+    assert "/%s && " % key in result.send((0, "", ""))
+    try:
+        result.send((0, "", ""))
+        assert False
+    except StopIteration:
+        pass
+    assert key != VirtualenvProvider(params=dict(
+        path='~/env', cache='~/.spaces/venvs'))._cache_key(interpreter[1])
+
     result = venv_provider.revert()
     assert "type -t deactivate" == result.next()
     assert "deactivate" == result.send((0, "function\n", ""))
@@ -313,22 +581,31 @@ if __name__ == "__main__":
 
     deb_provider = DebPkgProvider(params=dict(finger=None, wget='1.13.4'))
     result = deb_provider.provide()
-    assert "which apt-get" == result.next()
-    assert "which dpkg-query" == result.send((0, '/usr/bin/apt-get', ''))
+    fresh_check = ('test -n "$(find /var/lib/apt/lists -maxdepth 0 '
+                   '-mmin -60 2>/dev/null)"')
+    assert ["which apt-get", "which dpkg-query", fresh_check] == result.next()
     out = "/usr/bin/dpkg-query -W --showformat='${Package}==${Version}\n'"
-    assert out == result.send((0, '/usr/bin/dpkg-query', ''))
+    assert out == result.send([(0, '/usr/bin/apt-get', ''),
+                               (0, '/usr/bin/dpkg-query', ''), (1, '', '')])
     assert "sudo /usr/bin/apt-get update" == result.send(
             (0, "foo==1.1.1\nwget==1.0.1", ""))
     cmd = result.send((0, "", ""))
     assert "sudo /usr/bin/apt-get upgrade wget=1.13.4" == cmd
     cmd = result.send((0, "", ""))
     assert "sudo /usr/bin/apt-get install finger" == cmd
+    try:
+        result.send((100, "", "E: Unable to locate package finger"))
+        assert False
+    except StopTheLine as e:
+        assert "installation failed" in str(e)
 
     rpm_provider = RpmPkgProvider(params=dict(finger=None, wget='1.13.4'))
     result = rpm_provider.provide()
-    assert "which rpm" == result.next()
-    assert "which yum" == result.send((0, '/usr/bin/rpm', ''))
-    cmd = result.send((0, '/usr/bin/yum', ''))
+    fresh_check = ('test -n "$(find /var/cache/yum -name repomd.xml '
+                   '-mmin -60 2>/dev/null)"')
+    assert ["which rpm", "which yum", fresh_check] == result.next()
+    cmd = result.send([(0, '/usr/bin/rpm', ''), (0, '/usr/bin/yum', ''),
+                       (1, '', '')])
     assert "/usr/bin/rpm -qa" == cmd
     assert "sudo /usr/bin/yum makecache" == result.send(
             (0, "foo-1.1.1\nwget-1.0.1", ""))
@@ -336,14 +613,68 @@ if __name__ == "__main__":
     assert "sudo /usr/bin/yum upgrade -y wget-1.13.4" == cmd
     cmd = result.send((0, "", ""))
     assert "sudo /usr/bin/yum install -y finger" == cmd
+    try:
+        result.send((0, "", ""))
+        assert False
+    except StopIteration:
+        pass
+    result = RpmPkgProvider(params=dict(finger=None)).provide()
+    result.next()
+    result.send([(0, '/usr/bin/rpm', ''), (0, '/usr/bin/yum', ''),
+                 (0, '', '')])
+    assert "sudo /usr/bin/yum install -y finger" == result.send(
+            (0, "foo-1.1.1", ""))
+    try:
+        result.send((1, "", "No package finger available."))
+        assert False
+    except StopTheLine as e:
+        assert "installation failed" in str(e)
+
+    # fresh index is not refreshed, nothing to do means no refresh either
+    result = rpm_provider.provide()
+    result.next()
+    result.send([(0, '/usr/bin/rpm', ''), (0, '/usr/bin/yum', ''),
+                 (0, '', '')])
+    cmd = result.send((0, "foo-1.1.1\nwget-1.0.1", ""))
+    assert "sudo /usr/bin/yum upgrade -y wget-1.13.4" == cmd
+    result = RpmPkgProvider(params=dict(wget='1.0.1')).provide()
+    result.next()
+    result.send([(0, '/usr/bin/rpm', ''), (0, '/usr/bin/yum', ''),
+                 (1, '', '')])
+    try:
+        result.send((0, "foo-1.1.1\nwget-1.0.1", ""))
+        assert False
+    except StopIteration:
+        pass
+    # listings may come as lazy line streams; unrequested packages and
+    # unparsable lines are not kept
+    rpm_provider = RpmPkgProvider(params=dict(wget='1.0.1'))
+    assert {'wget': '1.0.1'} == rpm_provider._parse_installed(
+            iter(["foo-1.1.1", "gpg-pubkey", "wget-1.0.1"]), "-")
 
     git_provider = GitProvider(
         params=dict(origin='git@github.com/pajaco/spaces',
                     path='~/spaces', ignore=['*.swp']))
     result = git_provider.provide()
-    assert "which git" == result.next()
-    assert "test -d ~/spaces" == result.send((0, '/usr/bin/git', ''))
-    cmd = result.send((1, "", ""))
+    assert ["which git", "test -d ~/spaces"] == result.next()
+    cmd = result.send([(0, '/usr/bin/git', ''), (1, "", "")])
     assert "/usr/bin/git clone git@github.com/pajaco/spaces ~/spaces" == cmd
     cmd = result.send((0, "", ""))
-    assert "cat >>~/spaces/.git/info/exclude <<EOF*.swp\nEOF" == cmd
+    assert "cat >>~/spaces/.git/info/exclude <<'EOF'\n*.swp\nEOF" == cmd
+
+    git_provider = GitProvider(
+        params=dict(origin='git@github.com:pajaco/spaces', path='~/spaces',
+                    depth='1', mirror='~/.spaces/mirrors', update='yes'))
+    result = git_provider.provide()
+    mirror = "~/.spaces/mirrors/git_github.com_pajaco_spaces.git"
+    assert ["which git", "test -d ~/spaces", "test -d %s" % mirror] == \
+        result.next()
+    cmd = result.send([(0, '/usr/bin/git', ''), (1, "", ""), (0, "", "")])
+    assert "/usr/bin/git --git-dir=%s fetch --prune" % mirror == cmd
+    cmd = result.send((0, "", ""))
+    assert ("/usr/bin/git clone --depth 1 --reference %s --dissociate "
+            "git@github.com:pajaco/spaces ~/spaces" % mirror) == cmd
+    result = git_provider.provide()
+    result.next()
+    cmd = result.send([(0, '/usr/bin/git', ''), (0, "", ""), (0, "", "")])
+    assert "/usr/bin/git -C ~/spaces pull --ff-only" == cmd
@@ -0,0 +1,131 @@
+"""
+Provider classes by _provider name, imported when first asked for
+
+Built-in providers live in providers.providers, which is only imported
+once a plan needs one of them. Other packages add providers through the
+`spaces.providers` entry point group:
+
+    entry_points={'spaces.providers': ['Docker = spaces_docker:Docker']}
+
+Scanning entry points means importing pkg_resources and reading the
+metadata of every installed distribution, so the result is kept in an
+index file and only scanned again when sys.path or a directory on it
+changes (installing a distribution touches site-packages).
+"""
+
+import hashlib
+import importlib
+import json
+import os
+import sys
+import threading
+
+ENTRY_POINTS = 'spaces.providers'
+INDEX_PATH = os.path.expanduser("~/.spaces/providers.json")
+BUILTIN = dict((name, 'providers.providers:%s' % name) for name in (
+    'EnvProvider', 'VirtualenvProvider', 'PkgProvider', 'PipProvider',
+    'DebPkgProvider', 'RpmPkgProvider', 'GitProvider'))
+
+_index = None
+_classes = {}
+_lock = threading.Lock()
+
+
+class UnknownProvider(KeyError):
+    pass
+
+
+def path_key():
+    """Hash of sys.path and the modification times of its directories"""
+    digest = hashlib.sha1()
+    for entry in sys.path:
+        try:
+            mtime = os.stat(entry or os.curdir).st_mtime
+        except OSError:
+            mtime = None
+        digest.update("%s %r\n" % (entry, mtime))
+    return digest.hexdigest()
+
+
+def discover():
+    """name -> 'module:attribute' of the installed entry points"""
+    try:
+        import pkg_resources
+    except ImportError:
+        return {}
+    return dict((entry.name, "%s:%s" % (entry.module_name,
+                                        ".".join(entry.attrs)))
+                for entry in pkg_resources.iter_entry_points(ENTRY_POINTS))
+
+
+def load_index(path=INDEX_PATH):
+    """Discovered providers, from the index file while it is up to date"""
+    key = path_key()
+    if path is not None:
+        try:
+            with open(path) as f:
+                index = json.load(f)
+            if index['key'] == key:
+                return index['providers']
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+    found = discover()
+    if path is not None:
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(dict(key=key, providers=found), f)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            print >>sys.stderr, "Cannot write %s: %s" % (path, e)
+    return found
+
+
+def names():
+    """Every provider name known, built-in ones take precedence"""
+    global _index
+    if _index is None:
+        _index = dict(load_index(), **BUILTIN)
+    return _index
+
+
+def get(name):
+    """Provider class called name, imported if need be"""
+    with _lock:
+        try:
+            return _classes[name]
+        except KeyError:
+            pass
+        # built-ins need no scan of the entry points
+        target = BUILTIN.get(name) or names().get(name)
+        if target is None:
+            raise UnknownProvider(name)
+        module, attribute = target.split(":", 1)
+        provider = importlib.import_module(module)
+        for part in attribute.split("."):
+            provider = getattr(provider, part)
+        _classes[name] = provider
+        return provider
+
+
+if __name__ == "__main__":
+    import tempfile
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    path = os.path.join(tempfile.mkdtemp(), "providers.json")
+    assert load_index(path) == load_index(path)
+    with open(path) as f:
+        assert path_key() == json.load(f)['key']
+    assert 'providers.providers' not in sys.modules
+    assert get('GitProvider').__name__ == 'GitProvider'
+    assert get('GitProvider') is get('GitProvider')
+    _index = dict(load_index(path), **BUILTIN)
+    try:
+        get('NoSuchProvider')
+        assert False
+    except UnknownProvider:
+        pass
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
@@ -0,0 +1,567 @@
+#!/usr/bin/env python
+"""
+Assertions on the planning, scheduling and session logic of spaces.py,
+whose own __main__ is the command line:
+
+    python selftest.py
+
+Nothing runs in a shell: commands are answered by facts.SimulatedHost
+snapshots or by hand.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import spaces
+from providers import facts
+from providers.providers import StopTheLine
+from spaces_config import config
+from spaces_exec import shell
+from spaces_journal import journal
+
+SPACE = """
+[base]
+_provider: EnvProvider
+workspace: /ws
+
+[tools]
+_provider: EnvProvider
+tools: /tools
+
+[repo]
+_provider: GitProvider
+_uses: [base]
+origin: git@github.com:pajaco/spaces
+path: [base]:workspace/spaces
+"""
+
+HOST = facts.SimulatedHost(dict(
+    which=dict(git="/usr/bin/git"), env=dict(HOME="/home/dev")))
+
+
+class Recorder(object):
+    """Provider yielding the given steps and noting the results it gets"""
+    def __init__(self, name, steps, log):
+        self.name = name
+        self.steps = steps
+        self.log = log
+
+    def provide(self):
+        """Recording"""
+        for step in self.steps:
+            result = yield step
+            self.log.append((self.name, result))
+
+
+def write_space(directory, text, name="spaces.cfg"):
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+
+def commands(frames):
+    """(slot, command) pairs of a daemon answer"""
+    found = []
+    for name, payload in frames:
+        if name == "SLOT":
+            slot = int(payload)
+        elif name == "CMD":
+            found.append((slot, payload))
+    return found
+
+
+def answer(state, token, results):
+    """Send (slot, (status, stdout, stderr)) results of a session"""
+    frames = [("SESSION", token)]
+    for slot, (status, stdout, stderr) in results:
+        frames.extend([("SLOT", str(slot)), ("STATUS", str(status)),
+                       ("STDOUT", stdout), ("STDERR", stderr)])
+    return state.dispense(frames)
+
+
+def dialogue(state, host, request="PROVIDE", token=None):
+    """Complete dialogue answered by host; token and the commands run"""
+    frames = [(request, "")]
+    if token is not None:
+        frames.insert(0, ("SESSION", token))
+    frames = state.dispense(frames)
+    token = frames[0][1]
+    run = []
+    while commands(frames):
+        pending = commands(frames)
+        run.extend(pending)
+        frames = answer(state, token, [(slot, host.run(cmd))
+                                       for slot, cmd in pending])
+    assert ("END", "") == frames[1], frames
+    return token, run
+
+
+def test_scheduler():
+    # providers of a level run side by side, results go to their own slot
+    log = []
+    first = Recorder("first", ["a1", "a2"], log)
+    second = Recorder("second", ["b1"], log)
+    last = Recorder("last", ["c1"], log)
+    done = []
+    schedule = spaces.LevelScheduler([[first, second], [last]], 'provide',
+                                     done=done.append)
+    assert [(0, "Recording", "a1"), (1, "Recording", "b1")] == \
+        schedule.start()
+    assert 0 == schedule.level
+    assert [] == schedule.send(1, (0, "b", ""))
+    assert [second] == done
+    assert [(0, None, "a2")] == schedule.send(0, (0, "a", ""))
+    assert [("second", (0, "b", "")), ("first", (0, "a", ""))] == log
+    # the next level only starts once the current one is exhausted
+    assert [(2, "Recording", "c1")] == schedule.send(0, (1, "", ""))
+    assert 1 == schedule.level and last is schedule.owners[2]
+    assert [] == schedule.send(2, (0, "", ""))
+    assert schedule.finished
+    assert [second, first, last] == done
+
+    # a batch goes out at once, the generator gets all results together;
+    # what the facts know never reaches the client
+    log = []
+    host_facts = facts.HostFacts()
+    host_facts.observe("which git", (0, "/usr/bin/git", ""))
+    batch = Recorder("batch", [["which git", "env", "true"]], log)
+    schedule = spaces.LevelScheduler([[batch]], 'provide', host_facts)
+    assert [(0, "Recording", "env"), (0, None, "true")] == schedule.start()
+    assert [] == schedule.send(0, (0, "HOME=/home/dev", ""))
+    assert [] == schedule.send(0, (1, "", ""))
+    assert [("batch", [(0, "/usr/bin/git", ""), (0, "HOME=/home/dev", ""),
+                       (1, "", "")])] == log
+    assert schedule.finished
+    assert (0, "HOME=/home/dev", "") == host_facts.lookup("env")
+
+    # levels with nothing left to run are skipped
+    schedule = spaces.LevelScheduler([[Recorder("none", [], [])]],
+                                     'provide')
+    assert [] == schedule.start() and schedule.finished
+    # as are providers with nothing to revert
+    schedule = spaces.LevelScheduler([[Recorder("none", ["a"], [])]],
+                                     'revert')
+    assert [] == schedule.start() and schedule.finished
+
+
+def test_session(directory):
+    path = write_space(directory, SPACE)
+    state = spaces.SpaceState(path, plan_cache=None, journal_dir=None)
+    assert [["base", "tools"], ["repo"]] == \
+        [[entry.section for entry in level] for level in state.plan]
+
+    # the first level's slots arrive together, the git checkout after them
+    frames = state.dispense([("PROVIDE", "")])
+    token = frames[0][1]
+    assert [(0, "env"), (1, "env")] == commands(frames)
+    frames = answer(state, token, [(0, HOST.run("env"))])
+    assert [(0, "export workspace=/ws")] == commands(frames)
+    # slot 1 is still out on the client
+    assert [("SESSION", token), ("WAIT", "")] == \
+        answer(state, token, [(0, (0, "", ""))])
+    frames = answer(state, token, [(1, HOST.run("env"))])
+    assert [(1, "export tools=/tools")] == commands(frames)
+    frames = answer(state, token, [(1, (0, "", ""))])
+    assert [(2, "which git"), (2, "test -d /ws/spaces")] == commands(frames)
+    frames = answer(state, token, [(2, HOST.run("which git")),
+                                   (2, HOST.run("test -d /ws/spaces"))])
+    assert [(2, "/usr/bin/git clone git@github.com:pajaco/spaces "
+                "/ws/spaces")] == commands(frames)
+    # with nothing to ignore the clone is all there is to it
+    assert [("SESSION", token), ("END", "")] == \
+        answer(state, token, [(2, (0, "", ""))])
+    assert [("ERROR", "No session")] == \
+        state.dispense([("SLOT", "0"), ("STATUS", "0")])
+
+    # sessions have their own providers: each reverts what it saw
+    before = facts.SimulatedHost(dict(which=dict(git="/usr/bin/git"),
+                                      env=dict(tools="/opt/tools")))
+    first = state.dispense([("PROVIDE", "")])
+    second, _ = dialogue(state, HOST)
+    assert first[0][1] != second
+    token = first[0][1]
+    frames = first
+    while commands(frames):
+        frames = answer(state, token, [(slot, before.run(cmd))
+                                       for slot, cmd in commands(frames)])
+    _, run = dialogue(state, HOST, "REVERT", token)
+    assert (1, "export tools=/opt/tools") in run
+    _, run = dialogue(state, HOST, "REVERT", second)
+    assert (1, "unset tools") in run
+    assert (0, "unset workspace") in run
+
+    # a provider stopping the line ends the session with an error
+    checked_out = facts.SimulatedHost(dict(which=dict(git="/usr/bin/git"),
+                                           paths=["/ws/spaces"]))
+    frames = state.dispense([("PROVIDE", "")])
+    token = frames[0][1]
+    while commands(frames):
+        frames = answer(state, token, [(slot, checked_out.run(cmd))
+                                       for slot, cmd in commands(frames)])
+    assert [("SESSION", token), ("ERROR", "Directory already exists")] == \
+        frames
+    assert state.sessions[token].finished
+    _, run = dialogue(state, HOST, "REVERT", token)
+    assert (0, "unset workspace") in run
+
+    # a closed connection leaves a provided session without its facts, a
+    # reverted one is dropped; one still running is kept as it is
+    provided, _ = dialogue(state, HOST)
+    running = state.dispense([("PROVIDE", "")])[0][1]
+    state.get_session(running).facts.observe("which git", HOST.run(
+        "which git"))
+    assert state.sessions[provided].facts.lookup("which git") is not None
+    for token in (provided, second, running):
+        state.release(token)
+    assert state.sessions[provided].facts.lookup("which git") is None
+    assert second not in state.sessions
+    assert state.sessions[running].facts.lookup("which git") is not None
+    _, run = dialogue(state, HOST, "REVERT", provided)
+    assert (0, "unset workspace") in run
+
+
+def test_replan(directory):
+    directory = tempfile.mkdtemp(dir=directory)
+    edits = iter(range(1, 100))
+
+    def edit(name, text):
+        path = write_space(directory, text, name)
+        # mtimes of quick edits may not differ
+        when = time.time() + edits.next()
+        os.utime(path, (when, when))
+        return path
+
+    edit("base.cfg", "[base]\n_provider: EnvProvider\nworkspace: /ws\n")
+    main = SPACE[SPACE.index("[tools]"):]
+    path = edit("spaces.cfg", "%include base.cfg\n" + main)
+    state = spaces.SpaceState(path, plan_cache=None, journal_dir=None)
+
+    def entries():
+        return dict((entry.section, entry)
+                    for level in state.plan for entry in level)
+    before = entries()
+    assert set() == state.refresh()
+
+    # a section of its own is rebuilt alone
+    edit("spaces.cfg", "%include base.cfg\n" +
+         main.replace("tools: /tools", "tools: /opt/tools"))
+    assert set(["tools"]) == state.refresh()
+    after = entries()
+    assert dict(tools="/opt/tools") == after['tools'].params
+    assert before['base'] == after['base'] and \
+        before['repo'] == after['repo']
+
+    # a used one, here in a fragment, brings its users along
+    before = after
+    edit("base.cfg", "[base]\n_provider: EnvProvider\nworkspace: /src\n")
+    assert set(["base", "repo"]) == state.refresh()
+    after = entries()
+    assert "/src/spaces" == after['repo'].params['path']
+    assert before['repo'].fingerprint != after['repo'].fingerprint
+    assert before['tools'] == after['tools']
+
+    # sessions handing their token back provide the new plan as well
+    token, run = dialogue(state, HOST)
+    assert (1, "export tools=/opt/tools") in run
+    edit("spaces.cfg", "%include base.cfg\n" + main)
+    assert set(["tools"]) == state.refresh()
+    _, run = dialogue(state, HOST, token=token)
+    assert (1, "export tools=/tools") in run
+    after = entries()
+
+    # touching without changing anything rebuilds nothing, a config that
+    # cannot be read keeps the plan
+    edit("base.cfg", "[base]\n_provider: EnvProvider\nworkspace: /src\n")
+    assert set() == state.refresh() and after == entries()
+    edit("spaces.cfg", "%include base.cfg\n" +
+         main.replace("GitProvider", "GitProvder"))
+    assert set() == state.refresh() and after == entries()
+    os.remove(os.path.join(directory, "base.cfg"))
+    assert set() == state.refresh() and after == entries()
+
+    # the plan of a new version of a config takes the place of the old one
+    plans = os.path.join(directory, "plans")
+    other = edit("other.cfg", SPACE)
+    spaces.load_plan(other, plans)
+    path = edit("cached.cfg", SPACE)
+    state = spaces.SpaceState(path, plan_cache=plans, journal_dir=None)
+    assert 2 == len(os.listdir(plans))
+    edit("cached.cfg", SPACE.replace("tools: /tools", "tools: /opt/tools"))
+    assert set(["tools"]) == state.refresh()
+    assert sorted([os.path.basename(spaces.plan_path(path, plans)),
+                   os.path.basename(spaces.plan_path(other, plans))]) == \
+        sorted(os.listdir(plans))
+
+    # the config is read once for both the cache key and the parser
+    opened = []
+
+    def counting_open(name, *args):
+        opened.append(name)
+        return open(name, *args)
+
+    spaces.open = config.open = counting_open
+    try:
+        edit("cached.cfg", SPACE.replace("tools: /tools", "tools: /usr"))
+        spaces.load_plan(path, plans)
+    finally:
+        del spaces.open, config.open
+    assert 1 == opened.count(path)
+    assert 2 == len(os.listdir(plans))
+
+
+def test_coalesce(directory):
+    path = write_space(directory, """
+[web]
+_provider: PipProvider
+requests: 2.0
+six:
+
+[cli]
+_provider: PipProvider
+requests: 2.0
+click: 7.0
+
+[legacy]
+_provider: PipProvider
+requests: 1.0
+
+[base]
+_provider: EnvProvider
+workspace: /ws
+""", "packages.cfg")
+    plan = spaces.coalesce_packages(spaces.get_plan(spaces.get_config(path)))
+    assert 1 == len(plan)
+    base, merged, legacy = plan[0]
+    assert "base" == base.section
+    # sections agreeing on versions are merged, another version stays apart
+    assert "cli, web" == merged.section
+    assert dict(requests="2.0", six=[], click="7.0") == merged.params
+    assert dict(requests=("cli", "web"), six=("web",),
+                click=("cli",)) == merged.origins
+    assert "legacy" == legacy.section and legacy.origins is None
+
+    # a failure names the packages of every merged section
+    provider = spaces.instantiate(merged)
+    result = provider.provide()
+    assert "which pip" == result.next()
+    result.send((0, "/usr/bin/pip", ""))
+    assert "/usr/bin/pip install -U" == result.send((0, "", ""))
+    cmd = result.send((0, "", ""))
+    assert set(["click==7.0", "requests==2.0", "six"]) == \
+        set(cmd.split()[2:])
+    try:
+        result.send((1, "", "No matching distribution found for click"))
+        assert False
+    except StopTheLine as e:
+        assert "Installing packages failed ([cli]: click requests; " \
+            "[web]: requests six)" == str(e), e
+    # and each of them is journalled on its own
+    levels, applies = spaces.instantiate_plan(
+        spaces.get_plan(spaces.get_config(path)))
+    assert [["cli", "web"], ["legacy"]] == sorted(
+        [section for section, _ in applied]
+        for applied in applies.itervalues())
+
+
+def test_registry(directory):
+    directory = tempfile.mkdtemp(dir=directory)
+    paths = [write_space(directory, SPACE, "space%d.cfg" % i)
+             for i in range(3)]
+    registry = spaces.SpaceRegistry(max_spaces=2, plan_cache=None,
+                                    journal_dir=None)
+    try:
+        registry.get()
+        assert False
+    except spaces.SpaceError:
+        pass
+    first = registry.get(paths[0])
+    assert first is registry.get(paths[0])
+    registry.get(paths[1])
+    # the least recently used space goes once there are too many
+    registry.get(paths[0])
+    registry.get(paths[2])
+    stats = registry.stats()
+    assert sorted([paths[0], paths[2]]) == sorted(stats['spaces'])
+    assert (2, 3, 1) == (stats['hits'], stats['misses'], stats['evictions'])
+    assert 2 * first.size == stats['memory']
+    assert first is registry.get(paths[0])
+    assert first is not registry.get(paths[1])
+
+    # or once their plans take too much memory, keeping the latest one
+    registry = spaces.SpaceRegistry(max_memory=first.size + 1,
+                                    plan_cache=None, journal_dir=None)
+    registry.get(paths[0])
+    registry.get(paths[1])
+    assert [paths[1]] == registry.stats()['spaces'].keys()
+    registry = spaces.SpaceRegistry(max_memory=0, plan_cache=None,
+                                    journal_dir=None)
+    registry.get(paths[0])
+    stats = registry.stats()
+    assert [paths[0]] == stats['spaces'].keys() and 0 == stats['evictions']
+    try:
+        registry.get(os.path.join(directory, "missing.cfg"))
+        assert False
+    except spaces.SpaceError:
+        pass
+    assert 2 == registry.stats()['misses']
+    # a misspelt provider shows when the space is loaded, not once provided
+    try:
+        registry.get(write_space(directory, SPACE.replace(
+            "GitProvider", "GitProvder"), "typo.cfg"))
+        assert False
+    except spaces.SpaceError as e:
+        assert "Unknown provider GitProvder of [repo]" in str(e), e
+
+    # a space being loaded holds up its own clients only
+    registry = spaces.SpaceRegistry(plan_cache=None, journal_dir=None)
+    cached = registry.get(paths[1])
+    loading, release = threading.Event(), threading.Event()
+    space_state = spaces.SpaceState
+
+    class SlowState(space_state):
+        def __init__(self, *args, **kwargs):
+            loading.set()
+            release.wait()
+            space_state.__init__(self, *args, **kwargs)
+    got = []
+    clients = [threading.Thread(target=lambda: got.append(
+        registry.get(paths[0]))) for _ in range(2)]
+    spaces.SpaceState = SlowState
+    try:
+        clients[0].start()
+        loading.wait()
+        clients[1].start()
+        assert cached is registry.get(paths[1])
+        release.set()
+        for client in clients:
+            client.join()
+    finally:
+        spaces.SpaceState = space_state
+    assert 2 == len(got) and got[0] is got[1]
+    assert 2 == registry.stats()['misses']
+
+
+class Recording(object):
+    """Executor answering as host does and noting the commands it ran"""
+    def __init__(self, host):
+        self.host = host
+        self.run_commands = []
+
+    def run(self, cmd):
+        self.run_commands.append(cmd)
+        return self.host.run(cmd)
+
+
+def test_execute(directory):
+    path = write_space(directory, SPACE[:SPACE.index("[repo]")], "env.cfg")
+    plan = spaces.get_plan(spaces.get_config(path))
+    space = os.path.abspath(path)
+    runs = journal.Journal(os.path.join(directory, "execute"))
+    host = facts.SimulatedHost(dict(env=dict(tools="/opt/tools")))
+    # commands are echoed to stderr as they run
+    stderr, sys.stderr = sys.stderr, StringIO()
+    try:
+        try:
+            spaces.execute(plan, [host], 'revert', journal=runs,
+                           space=space)
+            assert False
+        except StopTheLine as e:
+            assert "Nothing backed up for [base], [tools], provide first" == \
+                str(e)
+        spaces.execute(plan, [host], journal=runs, space=space)
+        assert dict(base={}, tools=dict(tools="/opt/tools")) == \
+            runs.backups("localhost", space)
+        # runs start with new providers, the backups come from the journal
+        executor = Recording(host)
+        spaces.execute(plan, [executor], 'revert', journal=runs,
+                       space=space)
+        assert ["unset workspace", "export tools=/opt/tools"] == \
+            executor.run_commands
+        assert {} == runs.backups("localhost", space)
+    finally:
+        sys.stderr = stderr
+
+
+class Unreachable(object):
+    """Executor of a host that cannot be reached"""
+    def run(self, cmd):
+        raise shell.ShellError("Shell exited with 255")
+
+
+def test_fleet(directory):
+    path = write_space(directory, SPACE)
+    plan = spaces.get_plan(spaces.get_config(path))
+
+    def host(release="centos 7", **snapshot):
+        snapshot.setdefault('which', dict(git="/usr/bin/git"))
+        snapshot.setdefault('env', dict(HOME="/home/dev"))
+        snapshot['commands'] = {"cat /etc/os-release": (0, release, "")}
+        return facts.SimulatedHost(snapshot)
+
+    hosts = dict(a=host(), b=host(), c=host(env=dict(HOME="/root")),
+                 d=host(paths=["/ws/spaces"]), e=host("debian 12"),
+                 f=Unreachable())
+    messages = []
+    space = os.path.abspath(path)
+    fleet = spaces.Fleet(plan, hosts, jobs=2,
+                         progress=lambda *message: messages.append(message),
+                         journal=journal.Journal(directory), space=space)
+    outcomes = fleet.run()
+    # hosts alike are driven together, e has another release
+    assert ("a", "group of 4") in messages and ("e", "group of 1") in messages
+    # c answers env differently and splits off, d stops its line alone
+    assert dict(a='done', b='done', c='done', d='failed', e='done',
+                f='failed') == dict((name, outcome['status'])
+                                    for name, outcome in outcomes.iteritems())
+    assert "Directory already exists" == str(outcomes['d']['error'])
+    assert "Shell exited with 255" == str(outcomes['f']['error'])
+    assert 0 == outcomes['f']['commands']
+    assert outcomes['a']['commands'] == outcomes['c']['commands'] == \
+        outcomes['e']['commands']
+    assert outcomes['d']['commands'] < outcomes['a']['commands']
+    # only the checkouts done are journalled
+    fingerprint = plan[1][0].fingerprint
+    for name in "abce":
+        assert dict(repo=fingerprint) == fleet.journal.applied(name, space)
+    assert {} == fleet.journal.applied("d", space)
+    outcomes = spaces.Fleet(plan, dict(a=hosts['a']),
+                            journal=fleet.journal, space=space).run()
+    assert 4 == outcomes['a']['commands']  # both env sections, not the repo
+    # hosts telling only their ssh connections apart stay one group
+    spawned = []
+
+    class Watched(spaces.Fleet):
+        def _spawn(self, members, *args):
+            spawned.append(list(members))
+            spaces.Fleet._spawn(self, members, *args)
+
+    hosts = dict((name, host(env=dict(
+        HOME="/home/dev", SSH_CLIENT="10.0.0.1 %d 22" % port,
+        SSH_CONNECTION="10.0.0.1 %d 10.0.0.%d 22" % (port, port % 10))))
+        for name, port in [("g", 50001), ("h", 50002)])
+    outcomes = Watched(plan, hosts).run()
+    assert [["g", "h"]] == spawned
+    assert outcomes['g'] == outcomes['h'] == dict(status='done', error=None,
+                                                  commands=7)
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    try:
+        test_scheduler()
+        test_session(directory)
+        test_replan(directory)
+        test_coalesce(directory)
+        test_registry(directory)
+        test_execute(directory)
+        test_fleet(directory)
+    finally:
+        shutil.rmtree(directory)
@@ -1,115 +1,1454 @@
 #!/usr/bin/env python
 
 import sys, os, time
+import argparse
+import hashlib
+import cPickle
+import json
 from spaces_config import config
-from providers import providers
+from providers import facts, registry
+from spaces_protocol import protocol
+from spaces_trace import timing
+from spaces_exec import shell
+from spaces_journal import journal
 #from helpers import get_message, make_message
 import SocketServer
 import toposort
-import ipdb
 import re
+import itertools
+import threading
+import uuid
+from collections import namedtuple, OrderedDict
+from StringIO import StringIO
 
 reserved_option_names = ['_uses', '_provider']
 
-def get_config(filepath):
+SESSION_TTL = 12 * 60 * 60
+
+# bump whenever the shape of plan entries changes
+PLAN_VERSION = 3
+PLAN_CACHE_DIR = os.path.expanduser("~/.spaces/plans")
+WATCH_INTERVAL = 2
+PORT = 5007
+MAX_SPACES = 32
+MAX_PLAN_MEMORY = 256
+# what hosts are grouped by before provisioning a fleet
+FLEET_FACTS = ["uname -srm", "cat /etc/os-release"]
+# set by ssh per connection; no provider goes by them
+CONNECTION_VARIABLES = frozenset(["SSH_CLIENT", "SSH_CONNECTION", "SSH_TTY"])
+
+# provider is kept as a class name so the plan stays plain data; origins
+# maps packages to their sections when package sections got merged;
+# fingerprint covers provider, params and fingerprints of the used sections
+PlanEntry = namedtuple('PlanEntry',
+                       'section provider params origins uses fingerprint')
+PlanEntry.__new__.__defaults__ = (None, (), None)
+
+def get_config(filepath, data=None):
+    """Parsed config of filepath; data is its content when read already"""
     cfg = config.SpacesConfigParser(allow_no_value=True)
-    cfg.readfp(open(filepath))
+    if data is None:
+        cfg.readfp(open(filepath))
+    else:
+        cfg.readfp(StringIO(data), filepath)
     return cfg
 
-def sort_sections(config):
+def get_graph(config):
     graph = {}
     for section in config.sections():
         graph[section] = config.getuses(section)
-    return toposort.toposort_flatten(graph)
+    return graph
+
+def sort_sections(config):
+    return toposort.toposort_flatten(get_graph(config))
+
+def sort_levels(config):
+    """Sections grouped in dependency levels; a level only depends on the
+    ones before it"""
+    return [sorted(level) for level in toposort.toposort(get_graph(config))]
+
+def get_entry(config, sect):
+    params = {}
+    for opt in config.options(sect):
+        if opt not in reserved_option_names:
+            val = config.gettuple(sect, opt)
+            if len(val) == 1:
+                val = val[0]
+            params[opt] = val
+    return PlanEntry(sect, config.getprovider(sect), params,
+                     uses=tuple(sorted(config.getuses(sect))))
+
+def fingerprint(entry, used):
+    digest = hashlib.sha1()
+    digest.update(repr((entry.provider, sorted(entry.params.iteritems()),
+                        used)))
+    return digest.hexdigest()
+
+def fingerprint_plan(plan):
+    """Plan with the fingerprints of its entries filled in; levels come in
+    dependency order so used sections are done first"""
+    prints = {}
+    fingerprinted = []
+    for level in plan:
+        entries = []
+        for entry in level:
+            entry = entry._replace(fingerprint=fingerprint(
+                entry, [prints.get(used) for used in entry.uses]))
+            prints[entry.section] = entry.fingerprint
+            entries.append(entry)
+        fingerprinted.append(entries)
+    return fingerprinted
+
+def link_requirements(plan):
+    """Plan with the packages of the PipProvider sections using a cached
+    virtualenv, directly or not, linked to it as its _requirements, so the
+    cache is keyed and built with them"""
+    entries = [entry for level in plan for entry in level]
+    graph = dict((entry.section, entry.uses) for entry in entries)
+    by_section = dict((entry.section, entry) for entry in entries)
+    linked = {}
+    for entry in entries:
+        if entry.provider != 'VirtualenvProvider' or \
+                'cache' not in entry.params:
+            continue
+        packages = set()
+        for user in get_dependents(graph, [entry.section]):
+            if by_section[user].provider == 'PipProvider':
+                packages.update(
+                    package if not version else "%s==%s" % (package, version)
+                    for package, version in by_section[user].params.iteritems())
+        linked[entry.section] = tuple(sorted(packages))
+    if not linked:
+        return plan
+    return [[entry._replace(params=dict(entry.params,
+                                        _requirements=linked[entry.section]))
+             if entry.section in linked else entry for entry in level]
+            for level in plan]
+
+def get_plan(config):
+    """Levels of resolved plan entries, shared by all sessions"""
+    return fingerprint_plan(link_requirements(
+        [[get_entry(config, sect) for sect in level]
+         for level in sort_levels(config)]))
+
+def raw_sections(config):
+    """Uninterpolated options of every section, to tell what changed"""
+    return dict((sect, tuple(sorted(config.items(sect, raw=True))))
+                for sect in config.sections())
+
+def get_dependents(graph, sections):
+    """sections plus everything that uses them, directly or not"""
+    users = {}
+    for sect, uses in graph.iteritems():
+        for used in uses:
+            users.setdefault(used, set()).add(sect)
+    found = set(sections)
+    todo = list(found)
+    while todo:
+        for user in users.get(todo.pop(), ()):
+            if user not in found:
+                found.add(user)
+                todo.append(user)
+    return found
+
+def replan(config, plan, sections):
+    """Rebuild the entries of changed sections and of their dependents only
+
+    Returns the new plan, the new raw sections and the rebuilt section names.
+    """
+    new_sections = raw_sections(config)
+    graph = get_graph(config)
+    changed = [sect for sect, items in new_sections.iteritems()
+               if sections.get(sect) != items]
+    dirty = get_dependents(graph, changed)
+    entries = dict((entry.section, entry) for level in plan for entry in level)
+    new_plan = [[get_entry(config, sect) if sect in dirty else entries[sect]
+                 for sect in sorted(level)]
+                for level in toposort.toposort(graph)]
+    return (fingerprint_plan(link_requirements(new_plan)), new_sections,
+            dirty)
+
+def watched_files(cfg_file):
+    """Modification times of cfg_file and of the fragments it includes"""
+    mtimes = dict((path, config.mtime(path))
+                  for path in config.scan_includes(cfg_file))
+    mtimes[cfg_file] = os.stat(cfg_file).st_mtime
+    return mtimes
+
+def read_config(cfg_file):
+    with open(cfg_file, 'rb') as f:
+        return f.read()
+
+def plan_key(cfg_file, data=None):
+    """Hash of everything a compiled plan depends on; data is the content
+    of cfg_file when read already"""
+    if data is None:
+        data = read_config(cfg_file)
+    digest = hashlib.sha1()
+    digest.update("%d\n%s\n" % (PLAN_VERSION, " ".join(reserved_option_names)))
+    digest.update(data)
+    for path in config.scan_includes(cfg_file, data=data):
+        try:
+            stat = os.stat(path)
+            digest.update("%s %r %d\n" % (path, stat.st_mtime, stat.st_size))
+        except OSError:
+            digest.update("%s missing\n" % path)
+    return digest.hexdigest()
+
+def plan_path(cfg_file, cache_dir, data=None):
+    """Cache file of the plan of cfg_file: a hash of the config's path,
+    then plan_key; plans of older versions of the config share the first
+    part"""
+    return os.path.join(cache_dir, "%s-%s.plan" % (
+        hashlib.sha1(os.path.abspath(cfg_file)).hexdigest(),
+        plan_key(cfg_file, data)))
+
+def save_plan(plan, sections, path):
+    """Store plan as plain tuples, written aside and renamed into place"""
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        cPickle.dump(([[tuple(entry) for entry in level] for level in plan],
+                      sections), f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+
+def store_plan(cfg_file, plan, sections, cache_dir=PLAN_CACHE_DIR,
+               data=None):
+    """Store plan of cfg_file (read as data) in cache_dir, in place of the
+    plans of its previous versions"""
+    if cache_dir is None:
+        return
+    path = plan_path(cfg_file, cache_dir, data)
+    try:
+        save_plan(plan, sections, path)
+    except (IOError, OSError) as e:
+        print >>sys.stderr, "Cannot store plan in %s: %s" % (path, e)
+        return
+    prefix = os.path.basename(path).split("-", 1)[0] + "-"
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and name.endswith(".plan") and \
+                name != os.path.basename(path):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+
+def load_plan(cfg_file, cache_dir=PLAN_CACHE_DIR):
+    """Compiled plan and raw sections of cfg_file, from cache_dir when it
+    is up to date"""
+    # read once for both the cache key and the parser
+    data = read_config(cfg_file)
+    if cache_dir is not None:
+        path = plan_path(cfg_file, cache_dir, data)
+        try:
+            with open(path, 'rb') as f:
+                plan, sections = cPickle.load(f)
+            plan = [[PlanEntry(*entry) for entry in level] for level in plan]
+            check_providers(plan)
+            return plan, sections
+        except (IOError, EOFError, ValueError, TypeError,
+                cPickle.UnpicklingError):
+            pass
+    cfg = get_config(cfg_file, data)
+    plan, sections = get_plan(cfg), raw_sections(cfg)
+    check_providers(plan)
+    store_plan(cfg_file, plan, sections, cache_dir, data)
+    return plan, sections
+
+def check_providers(plan):
+    """Raise config.Error on a _provider no provider is registered under,
+    so it shows when the plan is loaded rather than once provided; the
+    providers themselves are not imported"""
+    for level in plan:
+        for entry in level:
+            if entry.provider not in registry.BUILTIN and \
+                    entry.provider not in registry.names():
+                raise config.Error("Unknown provider %s of [%s]" % (
+                    entry.provider, entry.section))
+
+def get_provider_class(name):
+    """Provider class of a _provider name, None for unknown ones"""
+    try:
+        return registry.get(name)
+    except registry.UnknownProvider:
+        return None
+
+def is_package_provider(name):
+    provider = get_provider_class(name)
+    return isinstance(provider, type) and issubclass(
+        provider, registry.get('PkgProvider'))
+
+def merge_package_entries(entries):
+    """One entry installing the packages of all entries at once
+
+    Sections asking for another version of an already merged package are
+    kept apart.
+    """
+    if len(entries) < 2:
+        return entries
+    params, origins, members, apart = {}, {}, [], []
+    for entry in entries:
+        if any(package in params and params[package] != version
+               for package, version in entry.params.iteritems()):
+            apart.append(entry)
+            continue
+        params.update(entry.params)
+        for package in entry.params:
+            origins[package] = origins.get(package, ()) + (entry.section,)
+        members.append(entry.section)
+    merged = PlanEntry(", ".join(members), entries[0].provider, params,
+                       origins)
+    return [merged] + apart
+
+def coalesce_packages(plan):
+    """Merge package sections of the same manager within each level, so
+    the level costs one index refresh and one install per manager"""
+    coalesced = []
+    for level in plan:
+        entries, groups = [], {}
+        for entry in level:
+            if is_package_provider(entry.provider):
+                groups.setdefault(entry.provider, []).append(entry)
+            else:
+                entries.append(entry)
+        for name in sorted(groups):
+            entries.extend(merge_package_entries(groups[name]))
+        coalesced.append(entries)
+    return coalesced
+
+def is_persistent(name):
+    """Whether what the provider sets up outlives the shell, so a section
+    applied once does not need applying again"""
+    return getattr(get_provider_class(name), 'persistent', False)
+
+def pending_plan(plan, applied, force=False):
+    """plan without the persistent sections applied with their current
+    fingerprint, as long as none of the sections they use is re-applied"""
+    if force:
+        return plan
+    entries = [entry for level in plan for entry in level]
+    redo = get_dependents(
+        dict((entry.section, entry.uses) for entry in entries),
+        [entry.section for entry in entries
+         if is_persistent(entry.provider) and
+         applied.get(entry.section) != entry.fingerprint])
+    pending = [[entry for entry in level
+                if entry.section in redo or not is_persistent(entry.provider)]
+               for level in plan]
+    return [level for level in pending if level]
+
+def entry_sections(entry):
+    if entry.origins:
+        return sorted(set(itertools.chain(*entry.origins.values())))
+    return [entry.section]
+
+def instantiate(entry):
+    provider = registry.get(entry.provider)(dict(entry.params))
+    if entry.origins:
+        provider.origins = entry.origins
+    return provider
+
+def instantiate_plan(plan):
+    """Provider levels of the coalesced plan, and the (section,
+    fingerprint) pairs each persistent provider applies"""
+    fingerprints = dict((entry.section, entry.fingerprint)
+                        for level in plan for entry in level)
+    levels, applies = [], {}
+    for level in coalesce_packages(plan):
+        instances = []
+        for entry in level:
+            provider = instantiate(entry)
+            if is_persistent(entry.provider):
+                applies[provider] = [(section, fingerprints.get(section))
+                                     for section in entry_sections(entry)]
+            instances.append(provider)
+        levels.append(instances)
+    return levels, applies
+
+def journal_completion(journal, host, space, provision_type, applies):
+    """Callback keeping the journal of space on host up to date as
+    providers complete"""
+    def done(provider):
+        applied = applies.get(provider)
+        if not applied:
+            return
+        if provision_type == 'provide':
+            journal.record(host, space, applied)
+        else:
+            journal.forget(host, space, [section for section, _ in applied])
+    return done
 
 def get_providers(config):
-    _providers = []
-    sorted_sections = sort_sections(config)
-    for sect in sorted_sections:
-        provider = getattr(providers, config.getprovider(sect))
-        params = {}
-        for opt in config.options(sect):
-            if opt not in reserved_option_names:
-                val = config.gettuple(sect, opt)
-                if len(val) == 1:
-                    val = val[0]
-                params[opt] = val
-        _providers.append(provider(params))
-    return _providers
-
-def parse_result(data):
-    parts = {}
-    ctx = None
-    for line in data.split("\n"):
-        if line.startswith("STATUS"):
-            parts['STATUS'] = line.split(" ", 1)[1].strip()
-        elif line.startswith("STDOUT"):
-            parts['STDOUT'] = []
-            ctx = "STDOUT"
-        elif line.startswith("STDERR"):
-            parts['STDERR'] = []
-            ctx = "STDERR"
+    return [instantiate(get_entry(config, sect))
+            for sect in sort_sections(config)]
+
+def get_provider_levels(config):
+    return [[instantiate(entry) for entry in level]
+            for level in get_plan(config)]
+
+def parse_result(frames):
+    """(status, stdout, stderr) of one executed command
+
+    Trailing newlines are dropped from outputs the way shell command
+    substitution does it, providers rely on that for `which` results.
+    Large outputs are left streamed (protocol.Output), their lines carry
+    no line endings anyway.
+    """
+    parts = dict(frames)
+    return (int(parts['STATUS']), _output(parts.get('STDOUT', '')),
+            _output(parts.get('STDERR', '')))
+
+def _output(payload):
+    if isinstance(payload, str):
+        return payload.rstrip("\n")
+    return payload
+
+def parse_results(frames):
+    """Split client frames into (slot, result) pairs, one per SLOT frame"""
+    results = []
+    slot, block = None, []
+    for name, payload in frames:
+        if name == "SLOT":
+            if slot is not None:
+                results.append((slot, parse_result(block)))
+            slot, block = int(payload), []
         else:
-            parts[ctx].append(line)
+            block.append((name, payload))
+    if slot is not None:
+        results.append((slot, parse_result(block)))
+    return results
 
-    return parts['STATUS'], parts['STDOUT'], parts['STDERR']
+def format_commands(commands):
+    frames = []
+    for slot, desc, cmd in commands:
+        frames.append(("SLOT", str(slot)))
+        if desc is not None:
+            frames.append(("DESC", desc))
+        frames.append(("CMD", cmd))
+    return frames
 
-def is_provide_request(data):
-    return data.startswith("PROVIDE")
+def get_request(frames):
+    """Name of the leading request frame (PROVIDE, REVERT, SLOT...)"""
+    return frames[0][0] if frames else None
 
 
-class SpaceState(object):
-    def __init__(self, cfg_file):
-        self.providers = get_providers(get_config(cfg_file))
-
-    def dispense(self, data):
-        if data.startswith("PROVIDE"):
-            self._providers = iter(self.providers)
-            self._curr_provider = None
-            self._curr_gen = None
-            self._provision_type = 'provide'
-        elif data.startswith("REVERT"):
-            self._providers = iter(self.providers)
-            self._curr_provider = None
-            self._curr_gen = None
-            self._provision_type = 'revert'
-
-        if not self._curr_provider:
+class LevelScheduler(object):
+    """Keeps every provider of a dependency level in flight at once
+
+    Each running provider generator gets a slot number; its commands are
+    handed out tagged with that slot so they can be executed concurrently
+    and the results routed back. The next level is only started once all
+    generators of the current one are exhausted.
+
+    Only --exec, with several shells, runs the slots concurrently: the
+    bin/spaces client evaluates commands in the user's own shell, so that
+    what they export sticks, and runs a message's slots one after another.
+
+    A generator may yield a list of independent commands instead of a
+    single one; they go out together and the generator is sent the list
+    of their results once all of them are back.
+
+    Probes the host facts already know the answer to are answered in
+    place and never reach the client.
+
+    Providers without a method for the provision type, like package and
+    git providers having nothing to revert, are left out.
+
+    With a tracer every provider, generator step and command is timed.
+    done is called with every provider whose generator completed.
+    """
+    def __init__(self, levels, provision_type, facts=None, tracer=None,
+                 done=None):
+        self._levels = iter(levels)
+        self._provision_type = provision_type
+        self._facts = facts
+        self._tracer = tracer
+        self._done = done
+        self._issued = {}
+        self._slots = itertools.count()
+        self._running = {}
+        self._pending = {}
+        self.owners = {}
+        self.level = -1
+        self.finished = False
+
+    def _lookup(self, cmd):
+        if self._facts is None:
+            return None
+        return self._facts.lookup(cmd)
+
+    def _issue(self, slot, desc, cmd):
+        """Commands to hand out for what slot's generator yielded"""
+        gen = self._running[slot]
+        while True:
+            batch = isinstance(cmd, (list, tuple))
+            cmds = list(cmd) if batch else [cmd]
+            results = [self._lookup(c) for c in cmds]
+            missing = [i for i, result in enumerate(results) if result is None]
+            if missing:
+                self._pending[slot] = (cmds, results, missing, batch)
+                self._issued[slot] = time.time()
+                return [(slot, desc if n == 0 else None, cmds[i])
+                        for n, i in enumerate(missing)]
+            cmd = gen.send(results if batch else results[0])
+
+    def _provider_name(self, slot):
+        return type(self.owners[slot]).__name__
+
+    def _advance(self, slot, desc, result=None, first=False):
+        gen = self._running[slot]
+        started = time.time()
+        try:
+            cmd = gen.next() if first else gen.send(result)
+            return self._issue(slot, desc, cmd)
+        except StopIteration:
+            del self._running[slot]
+            if self._tracer:
+                self._tracer.end(slot)
+            if self._done:
+                self._done(self.owners[slot])
+            return []
+        finally:
+            if self._tracer:
+                self._tracer.complete(
+                    self._provision_type, 'generator', slot + 1, started,
+                    time.time(), provider=self._provider_name(slot))
+
+    def _start_level(self):
+        started = []
+        while not started:
             try:
-                self._curr_provider = self._providers.next()
+                level = self._levels.next()
             except StopIteration:
-                return "END"
-        if self._curr_gen is None:
-            method = getattr(self._curr_provider, self._provision_type)
-            self._curr_gen = method()
-            cmd = self._curr_gen.next()
-            return "DESC %s\n\nCMD %s" % (method.__doc__, cmd)
+                self.finished = True
+                return started
+            self.level += 1
+            for provider in level:
+                method = getattr(provider, self._provision_type, None)
+                if method is None:
+                    continue
+                slot = self._slots.next()
+                self.owners[slot] = provider
+                self._running[slot] = method()
+                if self._tracer:
+                    self._tracer.begin(slot, self._provider_name(slot),
+                                       'provider', slot + 1,
+                                       provider=self._provider_name(slot),
+                                       level=self.level)
+                started.extend(self._advance(slot, method.__doc__, first=True))
+        return started
+
+    def start(self):
+        return self._start_level()
+
+    def stop(self):
+        """Give up on the providers still running, after one of them
+        stopped the line"""
+        self._running.clear()
+        self._pending.clear()
+        self.finished = True
+
+    def send(self, slot, result):
+        """Feed result of slot's command, returns the commands to run next"""
+        cmds, results, missing, batch = self._pending[slot]
+        i = missing.pop(0)
+        results[i] = result
+        if self._facts is not None:
+            self._facts.observe(cmds[i], result)
+        if self._tracer:
+            status, stdout, stderr = result
+            self._tracer.complete(
+                cmds[i], 'command', slot + 1, self._issued[slot], time.time(),
+                provider=self._provider_name(slot), status=status,
+                bytes_out=len(cmds[i]), bytes_in=len(stdout) + len(stderr))
+        if missing:
+            return []
+        del self._pending[slot]
+        commands = self._advance(slot, None, results if batch else results[0])
+        if commands or self._running:
+            return commands
+        return self._start_level()
+
+
+class Session(object):
+    """Provisioning cursor of a single client
+
+    Providers keep state between provide() and revert() (backups of the
+    environment etc), so every session gets its own instances built from
+    the shared plan. PROVIDE leaves out the sections the journal has as
+    applied unless it comes with FORCE; REVERT reverts what the session
+    provided, or the whole plan. The journal keeps its entries under
+    space, the absolute path of the config file.
+
+    Clients hand the token back on their next connection, so that REVERT
+    reaches the providers that ran PROVIDE.
+    """
+    def __init__(self, token, plan, host="localhost", refresh_log=None,
+                 trace_dir=None, journal=None, space=None):
+        self.token = token
+        self.plan = plan
+        self.host = host
+        self.trace_dir = trace_dir
+        self.journal = journal
+        self.space = space
+        self.tracer = None
+        self.runs = itertools.count()
+        self.levels = None
+        self.provision_type = None
+        self._applies = {}
+        self.facts = facts.HostFacts(host=host, refresh_log=refresh_log)
+        self.lock = threading.Lock()
+        self.last_seen = time.time()
+        self._schedule = None
+
+    def dispense(self, frames):
+        from providers.providers import StopTheLine
+        received = time.time()
+        if self.tracer and self._schedule and not self._schedule.finished:
+            self.tracer.complete("client", 'roundtrip', timing.SESSION_LANE,
+                                 self.last_seen, received,
+                                 bytes_in=sum(len(p) for _, p in frames))
+        self.last_seen = received
+        request = get_request(frames)
+        if request in ("PROVIDE", "REVERT"):
+            if self.trace_dir is not None:
+                self.tracer = timing.Tracer()
+            provision_type = self.provision_type = request.lower()
+            if request == "PROVIDE" or self.levels is None:
+                plan = self.plan
+                if request == "PROVIDE" and self.journal is not None:
+                    plan = pending_plan(plan, self.journal.applied(
+                        self.host, self.space), "FORCE" in dict(frames))
+                self.levels, self._applies = instantiate_plan(plan)
+            done = None
+            if self.journal is not None:
+                done = journal_completion(self.journal, self.host,
+                                          self.space, provision_type,
+                                          self._applies)
+            self._schedule = LevelScheduler(self.levels, provision_type,
+                                            self.facts, self.tracer, done)
+        elif self._schedule is None:
+            return [("ERROR", "Nothing to provide or revert")]
+
+        try:
+            if request in ("PROVIDE", "REVERT"):
+                commands = self._schedule.start()
+            else:
+                commands = []
+                for slot, result in parse_results(frames):
+                    commands.extend(self._schedule.send(slot, result))
+        except StopTheLine as e:
+            # the session is done with, the client says what went wrong
+            self._schedule.stop()
+            out = [("ERROR", str(e))]
         else:
+            if commands:
+                out = format_commands(commands)
+            elif self._schedule.finished:
+                out = [("END", "")]
+            else:
+                # other slots still running on the client side
+                out = [("WAIT", "")]
+        if self.tracer:
+            self.last_seen = time.time()
+            self.tracer.complete("daemon", 'roundtrip', timing.SESSION_LANE,
+                                 received, self.last_seen,
+                                 bytes_out=sum(len(p) for _, p in out))
+            if self._schedule.finished:
+                self.export_trace()
+        return out
+
+    @property
+    def finished(self):
+        return self._schedule is not None and self._schedule.finished
+
+    def export_trace(self):
+        path = os.path.join(self.trace_dir, "%s-%d.json" % (
+            self.token, self.runs.next()))
+        try:
+            self.tracer.export(path)
+        except IOError as e:
+            print >>sys.stderr, "Cannot write trace of session {}: {}".format(
+                self.token, e)
+            return
+        print "Trace of session {} written to {}\n{}".format(
+            self.token, path, self.tracer.format_summary())
+
+
+def dry_run(plan, host, provision_type='provide', tracer=None):
+    """Drive every provider of plan against a simulated host
+
+    Returns the ordered steps that would be sent to the client; a
+    StopTheLine ends the run with an error step.
+    """
+    from providers.providers import StopTheLine
+    levels = [[instantiate(entry) for entry in level] for level in plan]
+    sections = dict((id(provider), entry.section)
+                    for level, entries in zip(levels, plan)
+                    for provider, entry in zip(level, entries))
+    schedule = LevelScheduler(levels, provision_type, facts.HostFacts(),
+                              tracer)
+    steps = []
+    try:
+        commands = schedule.start()
+        while commands:
+            following = []
+            for slot, desc, cmd in commands:
+                provider = schedule.owners[slot]
+                status, _, _ = result = host.run(cmd)
+                steps.append(dict(level=schedule.level,
+                                  section=sections[id(provider)],
+                                  provider=type(provider).__name__,
+                                  command=cmd, status=status))
+                following.extend(schedule.send(slot, result))
+            commands = following
+    except StopTheLine as e:
+        steps.append(dict(level=schedule.level, error=str(e)))
+    return steps
+
+def run_commands(shells, commands):
+    """Run commands of different slots concurrently, one thread per shell;
+    returns results in the order of commands"""
+    assigned = {}
+    for n, (slot, desc, cmd) in enumerate(commands):
+        assigned.setdefault(slot % len(shells), []).append(n)
+    results = [None] * len(commands)
+
+    def work(co_process, indexes):
+        for n in indexes:
+            slot, desc, cmd = commands[n]
+            if desc is not None:
+                print >>sys.stderr, desc
+            print >>sys.stderr, cmd
+            results[n] = co_process.run(cmd)
+
+    workers = [threading.Thread(target=work, args=(shells[i], indexes))
+               for i, indexes in assigned.iteritems()]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+def sync_shells(shells, states):
+    """Share what every shell exported with the others, between levels"""
+    changes = [co_process.changes(state)
+               for co_process, state in zip(shells, states)]
+    for i, co_process in enumerate(shells):
+        for j, script in enumerate(changes):
+            if i != j and script:
+                co_process.run(script)
+    return [co_process.state() for co_process in shells]
+
+def backup_completion(journal, space, provision_type, levels, plan,
+                      done):
+    """Callback chained to done keeping the backups of providers having
+    one in the journal: stored once provided, dropped once reverted
+
+    Before reverting the providers get the backups stored for them.
+    """
+    from providers.providers import StopTheLine
+    sections = dict((provider, entry.section)
+                    for level, entries in zip(levels, coalesce_packages(plan))
+                    for provider, entry in zip(level, entries)
+                    if hasattr(provider, 'backup'))
+    if provision_type == 'revert' and sections:
+        backups = journal.backups("localhost", space)
+        missing = sorted(section for section in sections.itervalues()
+                         if section not in backups)
+        if missing:
+            raise StopTheLine("Nothing backed up for %s, provide first" %
+                              ", ".join("[%s]" % name for name in missing))
+        for provider, section in sections.iteritems():
+            provider.backup = backups[section]
+
+    def completed(provider):
+        done(provider)
+        if provider in sections:
+            journal.keep_backups("localhost", space, [(
+                sections[provider],
+                provider.backup if provision_type == 'provide' else None)])
+    return completed
+
+def execute(plan, shells, provision_type='provide', tracer=None,
+            journal=None, force=False, space=None):
+    """Provision straight into shell co-processes, without the daemon
+
+    Slots of a level are spread over the shells; before the next level
+    starts the shells exchange their exported variables and functions, so
+    each level sees what the previous ones set up. With a journal sections
+    of space (the absolute config path) already applied to this host are
+    skipped unless force is set, and what providers back up is kept there
+    for reverting; reverting sections with nothing backed up stops the
+    line.
+    """
+    done = None
+    if journal is not None and provision_type == 'provide':
+        plan = pending_plan(plan, journal.applied("localhost", space), force)
+    levels, applies = instantiate_plan(plan)
+    if journal is not None:
+        done = backup_completion(
+            journal, space, provision_type, levels, plan,
+            journal_completion(journal, "localhost", space, provision_type,
+                               applies))
+    schedule = LevelScheduler(levels, provision_type, facts.HostFacts(),
+                              tracer, done)
+    states = None
+    if len(shells) > 1:
+        states = [co_process.state() for co_process in shells]
+    commands = schedule.start()
+    level = schedule.level
+    while commands:
+        if states and schedule.level != level:
+            states = sync_shells(shells, states)
+            level = schedule.level
+        following = []
+        for (slot, _, _), result in zip(commands,
+                                        run_commands(shells, commands)):
+            following.extend(schedule.send(slot, result))
+        commands = following
+    if states:
+        sync_shells(shells, states)
+
+def format_steps(steps):
+    lines = []
+    for step in steps:
+        if 'error' in step:
+            lines.append("%d ERROR %s" % (step['level'], step['error']))
+        else:
+            lines.append("%(level)d [%(section)s] %(command)s [%(status)d]"
+                         % step)
+    return "\n".join(lines)
+
+
+def replay(plan, provision_type, transcript, completion=None):
+    """Scheduler brought to where a recorded dialogue left it, and the
+    commands it asks for next; nothing is executed
+
+    transcript holds the rounds of (slot, result) sent to a scheduler of
+    the same plan. Providers are deterministic, so fed the same results
+    they ask the same commands again. completion is given what the
+    providers apply (see instantiate_plan) and returns the scheduler's
+    done callback.
+    """
+    levels, applies = instantiate_plan(plan)
+    schedule = LevelScheduler(levels, provision_type, facts.HostFacts(),
+                              done=completion and completion(applies))
+    commands = schedule.start()
+    for sent in transcript:
+        commands = []
+        for slot, result in sent:
+            commands.extend(schedule.send(slot, result))
+    return schedule, commands
+
+
+def fleet_result(cmd, result):
+    """What hosts of a fleet are compared on in result of cmd: env output
+    leaves out CONNECTION_VARIABLES, which tell every host apart"""
+    if cmd != "env":
+        return result
+    status, stdout, stderr = result
+    return status, "\n".join(
+        line for line in stdout.split("\n")
+        if line.split("=", 1)[0] not in CONNECTION_VARIABLES), stderr
+
+class Fleet(object):
+    """Provisions one plan on many hosts at once
+
+    Hosts (name -> executor with a run(cmd) method, like shell.Shell or
+    facts.SimulatedHost) answering FLEET_FACTS the same way, and with the
+    same sections pending in the journal, form a group driven by a single
+    dialogue: every round of commands runs on all of the group's hosts and
+    as long as their results agree, providers work once for all of them.
+    Hosts whose results differ split into groups of their own, with a
+    dialogue rebuilt by replaying the group's transcript.
+
+    At most jobs hosts run commands at the same time. A StopTheLine or a
+    broken executor only ends the hosts concerned. progress is called with
+    a host name and a message. The journal keeps its entries under space,
+    the absolute path of the config file.
+    """
+    def __init__(self, plan, hosts, provision_type='provide', jobs=8,
+                 progress=None, journal=None, force=False, space=None):
+        self.plan = plan
+        self.hosts = hosts
+        self.provision_type = provision_type
+        self.progress = progress or (lambda name, message: None)
+        self.journal = journal
+        self.force = force
+        self.space = space
+        self.outcomes = dict((name, dict(status='pending', error=None,
+                                         commands=0)) for name in hosts)
+        self._slots = threading.BoundedSemaphore(max(1, jobs))
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _run_host(self, name, commands):
+        with self._slots:
+            results = []
+            for _, _, cmd in commands:
+                results.append(self.hosts[name].run(cmd))
+                status = results[-1][0]
+                self.progress(name, "%s [%d]" % (cmd, status))
+            return results
+
+    def _run_round(self, names, commands):
+        """host -> results of commands, or the exception the host failed
+        with"""
+        results = {}
+
+        def work(name):
             try:
-                return self._curr_gen.send(parse_result(data))
-            except StopIteration:
-                self._curr_provider = None
-                self._curr_gen = None
-                return self.dispense(data)
+                results[name] = self._run_host(name, commands)
+            except Exception as e:
+                results[name] = e
 
+        workers = [threading.Thread(target=work, args=(name,))
+                   for name in names]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results
 
-class SpacesTCPHandler(SocketServer.BaseRequestHandler):
-    def setup(self):
-        self.data = ""
-    def handle(self):
+    def _finish(self, names, status, error=None):
+        for name in names:
+            self.outcomes[name].update(status=status, error=error)
+            self.progress(name, status if error is None else
+                          "%s: %s" % (status, error))
+
+    def _completion(self, members):
+        """Journal callback factory for replay, recording for whoever is
+        in the group when a provider completes"""
+        if self.journal is None:
+            return None
+
+        def completion(applies):
+            def done(provider):
+                for name in list(members):
+                    journal_completion(self.journal, name, self.space,
+                                       self.provision_type, applies)(provider)
+            return done
+        return completion
+
+    def _group_plan(self, name):
+        if self.journal is None or self.provision_type != 'provide':
+            return self.plan
+        return pending_plan(self.plan, self.journal.applied(name, self.space),
+                            self.force)
+
+    def _spawn(self, *args):
+        thread = threading.Thread(target=self._drive, args=args)
+        with self._lock:
+            self._threads.append(thread)
+        thread.start()
+
+    def _start(self, members, plan, transcript):
+        """Scheduler and first commands of a group, None if it failed"""
+        from providers.providers import StopTheLine
+        try:
+            schedule, commands = replay(plan, self.provision_type, transcript,
+                                        self._completion(members))
+        except StopTheLine as e:
+            self._finish(members, 'failed', e)
+            return None, None
+        return schedule, commands
+
+    def _drive(self, members, plan, transcript):
+        """Run a group's dialogue to its end, splitting it on divergence"""
+        from providers.providers import StopTheLine
+        schedule, commands = self._start(members, plan, transcript)
+        while schedule is not None and commands:
+            results = self._run_round(members, commands)
+            partitions = OrderedDict()
+            for name in members:
+                if isinstance(results[name], Exception):
+                    self._finish([name], 'failed', results[name])
+                else:
+                    self.outcomes[name]['commands'] += len(commands)
+                    key = tuple(fleet_result(cmd, result) for (_, _, cmd),
+                                result in zip(commands, results[name]))
+                    partitions.setdefault(key, []).append(name)
+            if not partitions:
+                return
+            # a partition goes on with the results of its first host
+            rounds = [[(slot, result) for (slot, _, _), result
+                       in zip(commands, results[names[0]])]
+                      for names in partitions.itervalues()]
+            for names, sent in zip(partitions.values()[1:], rounds[1:]):
+                self._spawn(names, plan, transcript + [sent])
+            # the group carries on with the hosts agreeing with its first
+            members[:] = partitions.values()[0]
+            sent = rounds[0]
+            transcript = transcript + [sent]
+            following = []
+            try:
+                for slot, result in sent:
+                    following.extend(schedule.send(slot, result))
+            except StopTheLine as e:
+                self._finish(members, 'failed', e)
+                return
+            commands = following
+        if schedule is not None:
+            self._finish(members, 'done')
+
+    def run(self):
+        """Provision every host; returns host -> outcome dict with status
+        ('done' or 'failed'), error and number of commands run"""
+        groups = OrderedDict()
+        probes = [(None, None, cmd) for cmd in FLEET_FACTS]
+        for name, reported in sorted(self._run_round(self.hosts,
+                                                     probes).iteritems()):
+            if isinstance(reported, Exception):
+                self._finish([name], 'failed', reported)
+                continue
+            plan = self._group_plan(name)
+            key = (tuple(reported), tuple(entry.section for level in plan
+                                          for entry in level))
+            groups.setdefault(key, (plan, []))[1].append(name)
+        for plan, members in groups.itervalues():
+            for name in members:
+                self.progress(name, "group of %d" % len(members))
+            self._spawn(members, plan, [])
+        while self._threads:
+            with self._lock:
+                thread = self._threads.pop(0)
+            thread.join()
+        return self.outcomes
+
+
+def split_session(frames):
+    """Strip the leading SESSION frame if there is one"""
+    if frames and frames[0][0] == "SESSION":
+        return frames[0][1], frames[1:]
+    return None, frames
+
+
+def plan_size(plan):
+    """Rough memory footprint of a plan: its pickled size"""
+    return len(cPickle.dumps([[tuple(entry) for entry in level]
+                              for level in plan], cPickle.HIGHEST_PROTOCOL))
+
+
+class SpaceState(object):
+    def __init__(self, cfg_file, plan_cache=PLAN_CACHE_DIR, trace_dir=None,
+                 journal_dir=journal.JOURNAL_DIR, refresh_log=None):
+        self.cfg_file = cfg_file
+        self.plan_cache = plan_cache
+        self.trace_dir = trace_dir
+        self.journal = None
+        if journal_dir is not None:
+            self.journal = journal.Journal(journal_dir)
+        self._watched = watched_files(cfg_file)
+        self.sessions = {}
+        self.refresh_log = refresh_log or facts.RefreshLog(
+            facts.INDEX_MAX_AGE)
+        self._lock = threading.Lock()
+        self._set_plan(*load_plan(cfg_file, plan_cache))
+
+    def _set_plan(self, plan, sections):
+        size = plan_size(plan)
+        with self._lock:
+            self.plan, self._sections = plan, sections
+            self.size = size
+
+    def refresh(self):
+        """Re-plan when the config file or a fragment it includes changed
+        on disk
+
+        Only changed sections and their dependents are rebuilt. Sessions
+        already running keep the providers they were started with, new
+        ones get the new plan. Returns the rebuilt section names.
+        """
+        os.stat(self.cfg_file)  # the watcher reports a removed config
+        if all(config.mtime(path) == mtime
+               for path, mtime in self._watched.iteritems()):
+            return set()
+        self._watched = watched_files(self.cfg_file)
+        try:
+            data = read_config(self.cfg_file)
+            plan, sections, dirty = replan(
+                get_config(self.cfg_file, data), self.plan, self._sections)
+            check_providers(plan)
+        except (IOError, config.Error,
+                toposort.CircularDependencyError) as e:
+            print >>sys.stderr, "Keeping previous plan of %s: %s" % (
+                self.cfg_file, e)
+            return set()
+        self._set_plan(plan, sections)
+        store_plan(self.cfg_file, plan, sections, self.plan_cache, data)
+        return dirty
+
+    def get_session(self, token, host="localhost"):
+        with self._lock:
+            now = time.time()
+            for stale in [t for t, s in self.sessions.iteritems()
+                          if now - s.last_seen > SESSION_TTL]:
+                del self.sessions[stale]
+            if token is None or token not in self.sessions:
+                token = uuid.uuid4().hex
+                self.sessions[token] = Session(token, self.plan, host,
+                                               self.refresh_log,
+                                               self.trace_dir, self.journal,
+                                               self.cfg_file)
+            session = self.sessions[token]
+            # a returning client provides what the config says now; what
+            # it provided before is still reverted by the providers kept
+            session.plan = self.plan
+            return session
+
+    def release(self, token):
+        """The connection of session token closed
+
+        A finished session drops its facts, spooled outputs included; one
+        that finished reverting is dropped altogether.
+        """
+        with self._lock:
+            session = self.sessions.get(token)
+        if session is None:
+            return
+        with session.lock:
+            if not session.finished:
+                return
+            session.facts.close()
+            reverted = session.provision_type == 'revert'
+        if reverted:
+            with self._lock:
+                if self.sessions.get(token) is session:
+                    del self.sessions[token]
+
+    def dispense(self, frames):
+        token, frames = split_session(frames)
+        if token is None and get_request(frames) not in ("PROVIDE", "REVERT"):
+            return [("ERROR", "No session")]
+        host = dict(frames).get("HOST", "localhost")
+        session = self.get_session(token, host)
+        with session.lock:
+            out = session.dispense(frames)
+        return [("SESSION", session.token)] + out
+
+
+class SpaceError(Exception):
+    pass
+
+
+class SpaceRegistry(object):
+    """Spaces served by the daemon, loaded when first asked for
+
+    Loaded spaces are kept in least recently used order and evicted once
+    there are more than max_spaces of them or their plans take more than
+    max_memory bytes; the most recent one always stays. Connections hold
+    on to their space, so an evicted one is only gone for new sessions.
+    Spaces are loaded without holding up clients of other spaces; clients
+    of the space being loaded wait for it. Iterating gives the loaded
+    spaces (see ConfigWatcher).
+    """
+    def __init__(self, default=None, max_spaces=MAX_SPACES,
+                 max_memory=MAX_PLAN_MEMORY * 1024 * 1024, **options):
+        self.default = default
+        self.max_spaces = max_spaces
+        self.max_memory = max_memory
+        self.options = options
+        self.refresh_log = facts.RefreshLog(
+            facts.INDEX_MAX_AGE)
+        self.hits = self.misses = self.evictions = 0
+        self._states = OrderedDict()
+        # cfg_file -> event set once it is loaded, or failed to
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        with self._lock:
+            return iter(self._states.values())
+
+    def get(self, cfg_file=None):
+        """SpaceState of cfg_file (default: the daemon's space)"""
+        cfg_file = cfg_file or self.default
+        if not cfg_file:
+            raise SpaceError("No space given")
+        cfg_file = os.path.abspath(os.path.expanduser(cfg_file))
         while True:
-            data = self.request.recv(1024)
-            if data == '':
-                break
-            self.data += data.strip()
-            print "{} wrote: {}\n".format(self.client_address[0], data)
+            with self._lock:
+                state = self._states.pop(cfg_file, None)
+                if state is not None:
+                    self.hits += 1
+                    self._states[cfg_file] = state
+                    self._evict()
+                    return state
+                loading = self._loading.get(cfg_file)
+                if loading is None:
+                    self.misses += 1
+                    loading = self._loading[cfg_file] = threading.Event()
+                    break
+            # somebody else is loading it, see what came of that
+            loading.wait()
+        # loading big spaces takes a while, other clients go on meanwhile
+        try:
+            state = SpaceState(cfg_file, refresh_log=self.refresh_log,
+                               **self.options)
+        except (IOError, OSError, config.Error,
+                toposort.CircularDependencyError) as e:
+            state = None
+            raise SpaceError("Cannot load %s: %s" % (cfg_file, e))
+        finally:
+            with self._lock:
+                del self._loading[cfg_file]
+                if state is not None:
+                    self._states[cfg_file] = state
+                    self._evict()
+            loading.set()
+        return state
 
-        out = self.server.state.dispense(self.data)
-        self.request.send(out)
+    def _evict(self):
+        while len(self._states) > 1 and (
+                len(self._states) > self.max_spaces or
+                sum(s.size for s in self._states.itervalues()) >
+                self.max_memory):
+            self._states.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions,
+                        memory=sum(s.size for s in self._states.itervalues()),
+                        spaces=dict((cfg_file, dict(size=state.size,
+                                                    sessions=len(state.sessions)))
+                                    for cfg_file, state
+                                    in self._states.iteritems()))
+
+
+class ConfigWatcher(threading.Thread):
+    """Polls config files of the given states and re-plans changed ones"""
+    def __init__(self, states, interval=WATCH_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.states = states
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            for state in list(self.states):
+                try:
+                    dirty = state.refresh()
+                except OSError as e:
+                    print >>sys.stderr, "Cannot watch %s: %s" % (
+                        state.cfg_file, e)
+                    continue
+                if dirty:
+                    print "{}: re-planned {}".format(
+                        state.cfg_file, ", ".join(sorted(dirty)))
+
+
+class SpacesTCPHandler(SocketServer.StreamRequestHandler):
+    """Exchanges framed messages over one connection until the client
+    hangs up; the space and session token are remembered for the
+    connection"""
+    wbufsize = -1
+
+    def handle(self):
+        token, state = None, None
+        try:
+            while True:
+                try:
+                    frames = protocol.read_message(self.rfile)
+                except EOFError:
+                    break
+                except protocol.ProtocolError as e:
+                    protocol.write_message(self.wfile, [("ERROR", str(e))])
+                    break
+                try:
+                    if get_request(frames) == "STATS":
+                        protocol.write_message(self.wfile, [
+                            ("STATS", json.dumps(self.server.spaces.stats()))])
+                        continue
+                    space = dict(frames).get("SPACE")
+                    if state is None or space is not None:
+                        try:
+                            space = self.server.spaces.get(space)
+                        except SpaceError as e:
+                            protocol.write_message(self.wfile,
+                                                   [("ERROR", str(e))])
+                            continue
+                        if space is not state:
+                            if token is not None:
+                                state.release(token)
+                            state, token = space, None
+                    if token is not None and get_request(frames) != "SESSION":
+                        frames.insert(0, ("SESSION", token))
+                    out = state.dispense(frames)
+                    if out[0][0] == "SESSION":
+                        token = out[0][1]
+                    protocol.write_message(self.wfile, out)
+                except Exception as e:
+                    # the client waits for an answer; the server reports
+                    # the error once the handler gave up
+                    protocol.write_message(self.wfile, [
+                        ("ERROR", "%s: %s" % (type(e).__name__, e))])
+                    raise
+        finally:
+            if token is not None:
+                state.release(token)
+
+
+class SpacesServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Serves every client connection in its own thread"""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+    debug = False
+
+    def handle_error(self, request, client_address):
+        SocketServer.TCPServer.handle_error(self, request, client_address)
+        if self.debug:
+            post_mortem(sys.exc_info()[2])
+
+def post_mortem(traceback):
+    # ipdb pulls in IPython, far too slow to import unless debugging
+    import ipdb
+    ipdb.post_mortem(traceback)
+
+def debug_hook(type_, value, traceback):
+    sys.__excepthook__(type_, value, traceback)
+    post_mortem(traceback)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Spaces daemon")
+    parser.add_argument("cfg_file", nargs="?",
+                        help="space to serve when clients name none "
+                             "(required with --dry-run and --exec)")
+    parser.add_argument("--dry-run", metavar="SNAPSHOT",
+                        help="print the command plan against a host facts "
+                             "snapshot (JSON) instead of serving")
+    parser.add_argument("--exec", action="store_true", dest="execute",
+                        help="provision in shell co-processes and print the "
+                             "resulting environment as a script to eval")
+    parser.add_argument("--fleet", nargs="+", metavar="HOST",
+                        help="provision these hosts over ssh at once; "
+                             "host facts snapshots (*.json) stand in for "
+                             "hosts")
+    parser.add_argument("--jobs", type=int,
+                        help="shells to run independent providers in "
+                             "(exec, default 1) or hosts provisioned at "
+                             "once (fleet, default 8)")
+    parser.add_argument("--revert", action="store_true",
+                        help="revert instead of provide (dry run, exec, "
+                             "fleet)")
+    parser.add_argument("--force", action="store_true",
+                        help="re-apply sections the journal has as applied "
+                             "(exec, fleet)")
+    parser.add_argument("--json", action="store_true",
+                        help="dry run output as JSON")
+    parser.add_argument("--trace", metavar="DIR",
+                        help="write a timeline of every provisioning run "
+                             "(Chrome trace JSON) to DIR")
+    parser.add_argument("--index-max-age", type=int, metavar="SECONDS",
+                        default=facts.INDEX_MAX_AGE,
+                        help="refresh package indexes older than this")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--max-spaces", type=int, default=MAX_SPACES,
+                        help="spaces kept loaded at most")
+    parser.add_argument("--max-plan-memory", type=int, metavar="MB",
+                        default=MAX_PLAN_MEMORY,
+                        help="memory loaded plans are kept under")
+    parser.add_argument("--debug", action="store_true",
+                        help="drop into ipdb on errors")
+    args = parser.parse_args(argv)
+    if (args.dry_run or args.execute or args.fleet) and not args.cfg_file:
+        parser.error("a space config file is required")
+    # traces are written once runs end, too late to find DIR missing
+    if args.trace and not os.path.isdir(args.trace):
+        try:
+            os.makedirs(args.trace)
+        except OSError as e:
+            parser.error("cannot create %s: %s" % (args.trace, e))
+    return args
 
 if __name__ == "__main__":
-    cfg_file = sys.argv[1]
-    HOST, PORT = "localhost", 5007
-    server = SocketServer.TCPServer((HOST, PORT), SpacesTCPHandler)
-    server.state = SpaceState(cfg_file)
+    args = parse_args(sys.argv[1:])
+    facts.INDEX_MAX_AGE = args.index_max_age
+    if args.debug:
+        sys.excepthook = debug_hook
+    if args.dry_run:
+        plan, _ = load_plan(args.cfg_file)
+        run_tracer = timing.Tracer() if args.trace else None
+        steps = dry_run(coalesce_packages(plan),
+                        facts.SimulatedHost.load(args.dry_run),
+                        'revert' if args.revert else 'provide', run_tracer)
+        if run_tracer:
+            run_tracer.export(os.path.join(args.trace, "dry-run.json"))
+            print >>sys.stderr, run_tracer.format_summary()
+        print json.dumps(steps, indent=2) if args.json else format_steps(steps)
+        sys.exit(1 if steps and 'error' in steps[-1] else 0)
+    if args.execute:
+        from providers.providers import StopTheLine
+        plan, _ = load_plan(args.cfg_file)
+        # space_exec hands over the prompt and an active virtualenv, which
+        # the environment does not carry; the co-processes need not see it
+        seed = os.environ.pop("SPACES_SHELL_STATE", None)
+        shells = [shell.Shell(seed=seed)
+                  for _ in range(max(1, args.jobs or 1))]
+        run_tracer = timing.Tracer() if args.trace else None
+        status = 0
+        try:
+            execute(plan, shells, 'revert' if args.revert else 'provide',
+                    run_tracer, journal.Journal(), args.force,
+                    os.path.abspath(args.cfg_file))
+        except StopTheLine as e:
+            print >>sys.stderr, "ERROR %s" % e
+            status = 1
+        # whatever got set up so far ends up in the user's shell
+        print shells[0].changes()
+        for co_process in shells:
+            co_process.close()
+        if run_tracer:
+            run_tracer.export(os.path.join(args.trace, "exec.json"))
+            print >>sys.stderr, run_tracer.format_summary()
+        sys.exit(status)
+    if args.fleet:
+        plan, _ = load_plan(args.cfg_file)
+        hosts, unreachable = {}, {}
+        for host in args.fleet:
+            try:
+                if host.endswith(".json"):
+                    hosts[host] = facts.SimulatedHost.load(host)
+                else:
+                    # an unreachable host fails on its first command, in
+                    # its own worker, without holding up the others
+                    hosts[host] = shell.Shell(
+                        ("ssh", "-T", host, "bash --noprofile --norc"),
+                        initial_state=False)
+            except (IOError, OSError, ValueError) as e:
+                unreachable[host] = dict(status='failed', error=e,
+                                         commands=0)
+        progress_lock = threading.Lock()
+
+        def progress(host, message):
+            with progress_lock:
+                print >>sys.stderr, "%s: %s" % (host, message)
+        outcomes = Fleet(plan, hosts, 'revert' if args.revert else 'provide',
+                         args.jobs or 8, progress, journal.Journal(),
+                         args.force, os.path.abspath(args.cfg_file)).run()
+        outcomes.update(unreachable)
+        for host, outcome in sorted(outcomes.iteritems()):
+            print "%s %s (%d commands)%s" % (
+                host, outcome['status'], outcome['commands'],
+                "" if outcome['error'] is None else ": %s" % outcome['error'])
+        for executor in hosts.itervalues():
+            if isinstance(executor, shell.Shell):
+                executor.close()
+        sys.exit(0 if all(outcome['status'] == 'done'
+                          for outcome in outcomes.itervalues()) else 1)
+    server = SpacesServer(("localhost", args.port), SpacesTCPHandler)
+    server.debug = args.debug
+    server.spaces = SpaceRegistry(args.cfg_file, args.max_spaces,
+                                  args.max_plan_memory * 1024 * 1024,
+                                  trace_dir=args.trace)
+    if args.cfg_file:
+        server.spaces.get()
+    ConfigWatcher(server.spaces).start()
     server.serve_forever()
@@ -7,18 +7,178 @@ Regular ini rules, except:
     keys can have no value
     values can be lists (whitespace is separator)
     values can contain references to other sections and particular keys in them
+
+    %include <path> pulls in the sections of a fragment file (path relative
+    to the including file); sections of the including file and of later
+    includes extend and override earlier ones. Fragments are parsed once
+    and kept while their files, and the ones they include, are unchanged.
 """
 
 
 from ConfigParser import (ConfigParser, NoOptionError, Error,
-                          NoSectionError, MAX_INTERPOLATION_DEPTH)
+                          NoSectionError, InterpolationError,
+                          InterpolationMissingOptionError)
+from StringIO import StringIO
+import os
 import re
 
+_INCLUDE = re.compile(r"^%include\s+(.+?)\s*$")
+
+# (path, allow_no_value) -> (files with mtimes, defaults, sections)
+_fragments = {}
+
+
+class IncludeError(Error):
+    pass
+
+
+class InterpolationCycleError(InterpolationError):
+    """Raised when values reference each other in a loop"""
+    def __init__(self, option, section, chain):
+        msg = "Reference cycle: %s" % " -> ".join(
+            "[%s]:%s" % key for key in chain)
+        InterpolationError.__init__(self, option, section, msg)
+        self.chain = chain
+
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _include_base(fpname):
+    if os.path.isfile(fpname):
+        return os.path.dirname(os.path.abspath(fpname))
+    return os.getcwd()
+
+
+def _include_path(base, include):
+    return os.path.abspath(os.path.join(base, os.path.expanduser(include)))
+
+
+def scan_includes(path, found=None, data=None):
+    """Files path includes, directly or not, without parsing anything;
+    data is the content of path when it was read already"""
+    found = [] if found is None else found
+    try:
+        if data is None:
+            with open(path) as f:
+                data = f.read()
+    except IOError:
+        return found
+    includes = [match.group(1)
+                for match in map(_INCLUDE.match, data.splitlines()) if match]
+    for include in includes:
+        include = _include_path(_include_base(path), include)
+        if include not in found:
+            found.append(include)
+            scan_includes(include, found)
+    return found
+
 
 class SpacesConfigParser(ConfigParser):
     _USES_OPT = "_uses"
     _PROVIDER_OPT = "_provider"
 
+    def __init__(self, *args, **kwargs):
+        ConfigParser.__init__(self, *args, **kwargs)
+        # included files with the mtimes they were read with
+        self.fragments = []
+        self._including = ()
+        self._invalidate()
+
+    def _invalidate(self):
+        """Drop resolved values; any change may affect every reference"""
+        self._resolved = {}
+        self._resolving = []
+        self._option_index = {}
+
+    def _read(self, fp, fpname):
+        self._invalidate()
+        # files being read, for the ones they include to spot a cycle
+        including = self._including
+        if os.path.isfile(fpname):
+            self._including += (os.path.abspath(fpname),)
+        try:
+            lines, includes = [], []
+            for line in iter(fp.readline, ""):
+                match = _INCLUDE.match(line)
+                if match:
+                    includes.append(match.group(1))
+                    line = "\n"  # keeps line numbers of parsing errors right
+                lines.append(line)
+            for include in includes:
+                self._include(_include_path(_include_base(fpname), include))
+        finally:
+            self._including = including
+        ConfigParser._read(self, StringIO("".join(lines)), fpname)
+
+    def _include(self, path):
+        if path in self._including:
+            raise IncludeError("Include cycle: %s" % " -> ".join(
+                self._including + (path,)))
+        files, defaults, sections = self._fragment(path)
+        self.fragments.extend(files)
+        self._defaults.update(defaults)
+        for name, options in sections.iteritems():
+            if name in self._sections:
+                self._sections[name].update(options)
+            else:
+                # copied, the cached ones are shared with other spaces
+                self._sections[name] = self._dict(options)
+
+    def _fragment(self, path):
+        no_value = self._optcre is self.OPTCRE_NV
+        cached = _fragments.get((path, no_value))
+        if cached and all(mtime(f) == m for f, m in cached[0]):
+            return cached
+        parser = self.__class__(allow_no_value=no_value)
+        parser._including = self._including + (path,)
+        modified = mtime(path)
+        with open(path) as f:
+            parser._read(f, path)
+        fragment = ([(path, modified)] + parser.fragments, parser._defaults,
+                    parser._sections)
+        _fragments[(path, no_value)] = fragment
+        return fragment
+
+    def add_section(self, section):
+        self._invalidate()
+        ConfigParser.add_section(self, section)
+
+    def set(self, section, option, value=None):
+        self._invalidate()
+        ConfigParser.set(self, section, option, value)
+
+    def remove_option(self, section, option):
+        self._invalidate()
+        return ConfigParser.remove_option(self, section, option)
+
+    def remove_section(self, section):
+        self._invalidate()
+        return ConfigParser.remove_section(self, section)
+
+    def get(self, section, option, raw=False, vars=None):
+        if raw or vars:
+            return ConfigParser.get(self, section, option, raw, vars)
+        key = (section, self.optionxform(option))
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        if key in self._resolving:
+            chain = self._resolving[self._resolving.index(key):] + [key]
+            raise InterpolationCycleError(key[1], section, chain)
+        self._resolving.append(key)
+        try:
+            value = ConfigParser.get(self, section, option)
+        finally:
+            self._resolving.pop()
+        self._resolved[key] = value
+        return value
+
     def gettuple(self, section, option):
         value = self.get(section, option)
         return list(filter(None, (x.strip() for x in value.splitlines())))
@@ -37,13 +197,12 @@ class SpacesConfigParser(ConfigParser):
         except NoOptionError:
             pass
 
-        # now those used for interpolation
+        # now those used for interpolation, wherever they are in the value
         for o, v in self.items(section, raw=True):
-            m = self._KEYCRE.match(v)
-            if m.group(1):
-                if not self.has_section(m.group(1)):
-                    raise NoSectionError(m.group(1))
-                out.append(m.group(1))
+            for used, _ in self._REFCRE.findall(v or ""):
+                if not self.has_section(used):
+                    raise NoSectionError(used)
+                out.append(used)
 
         return set(out)
 
@@ -51,46 +210,39 @@ class SpacesConfigParser(ConfigParser):
         return self.get(section, self._PROVIDER_OPT)
 
     def _interpolate(self, section, option, rawval, vars):
-        # do the string interpolation
-        value = rawval
-        depth = MAX_INTERPOLATION_DEPTH
-        while depth:                    # Loop through this until it's done
-            depth -= 1
-            if value and "[" in value:
-                value = self._KEYCRE.sub(self._interpolation_replace, value)
-                try:
-                    value = value % vars
-                except KeyError, e:
-                    raise InterpolationMissingOptionError(
-                        option, section, rawval, e.args[0])
-            else:
-                break
-        if value and "%(" in value:
-            raise InterpolationDepthError(option, section, rawval)
-        return value
+        # referenced values come back fully resolved (and memoized) from
+        # get(), so a single substitution pass is enough
+        if not rawval or "[" not in rawval:
+            return rawval
+        value = self._REFCRE.sub(self._interpolation_replace, rawval)
+        try:
+            return value % vars
+        except KeyError, e:
+            raise InterpolationMissingOptionError(
+                option, section, rawval, e.args[0])
 
-    _KEYCRE = re.compile(r"\[([^\]]*)\]:(\S+)|.")
+    _REFCRE = re.compile(r"\[([^\]]*)\]:(\S+)")
+
+    def _options_of(self, section):
+        try:
+            return self._option_index[section]
+        except KeyError:
+            index = self._option_index[section] = frozenset(
+                self.options(section))
+            return index
 
     def _interpolation_replace(self, match):
         s = match.group(1)
-        if s is None:
-            return match.group()
-        elif self.has_section(s):
-            o = match.group(2)
-            if o is None:
-                return match.group()
-            # try exact match
-            if self.has_option(s, o):
-                return self.get(s, o)
-
-            # try partial; longest first
-            for option in reversed(sorted(self.options(s))):
-                if o.startswith(option):
-                    v = self.get(s, option, raw=True)
-                    return v + o[len(option):]
-            raise NoOptionError(s, o)
-        else:
+        if not self.has_section(s):
             raise NoSectionError(s)
+        o = match.group(2)
+        options = self._options_of(s)
+        # exact match first, then partial; longest first
+        for end in xrange(len(o), 0, -1):
+            name = self.optionxform(o[:end])
+            if name in options:
+                return self.get(s, name) + o[end:]
+        raise NoOptionError(o, s)
 
 
 
@@ -121,5 +273,59 @@ _provider: FooProvider
     #print config.gettuple('test section 1', 'testkeya')
     print config.getuses('test section 1')
     print config.getuses('test section 2')
+    assert "1foo" == config.get('test section 2', 'testkeya')
+    config.set('test section 1', 'testkeya', '2')
+    assert "2foo" == config.get('test section 2', 'testkeya')
+    config.set('test section 2', 'mixed', '[test section 1]:TestKeyA/src')
+    assert "2/src" == config.get('test section 2', 'mixed')
+
+    config.set('test section 1', 'loop', '[test section 2]:loop')
+    config.set('test section 2', 'loop', '[test section 1]:loop')
+    try:
+        config.get('test section 1', 'loop')
+        assert False
+    except InterpolationCycleError as e:
+        assert 3 == len(e.chain)
+
+    import shutil
+    import tempfile
+    library = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(library, "base.cfg"), "w") as f:
+            f.write("[base]\nroot: /srv\n_provider: EnvProvider\n")
+        with open(os.path.join(library, "tools.cfg"), "w") as f:
+            f.write("%include base.cfg\n[tools]\npath: [base]:root/tools\n"
+                    "_provider: EnvProvider\n")
+        space = os.path.join(library, "space.cfg")
+        with open(space, "w") as f:
+            f.write("%include tools.cfg\n[base]\nroot: /opt\n[mine]\n"
+                    "_uses: [tools]\nbin: [tools]:path/bin\n")
+        config = SpacesConfigParser(allow_no_value=True)
+        config.read(space)
+        assert "/opt/tools/bin" == config.get('mine', 'bin')
+        assert set(['tools']) == config.getuses('mine')
+        assert [os.path.join(library, "tools.cfg"),
+                os.path.join(library, "base.cfg")] == scan_includes(space)
+        assert 2 == len(config.fragments)
+        cached = _fragments[(os.path.join(library, "tools.cfg"), True)]
+        other = SpacesConfigParser(allow_no_value=True)
+        other.read(space)
+        assert cached is _fragments[(os.path.join(library, "tools.cfg"), True)]
+        assert "/srv" == cached[2]['base']['root']
+        # reading a file along with one that includes it is no cycle
+        config = SpacesConfigParser(allow_no_value=True)
+        config.read([os.path.join(library, "base.cfg"),
+                     os.path.join(library, "tools.cfg")])
+        assert "/srv/tools" == config.get('tools', 'path')
+        with open(os.path.join(library, "base.cfg"), "a") as f:
+            f.write("%include space.cfg\n")
+        os.utime(os.path.join(library, "base.cfg"), (0, 0))
+        try:
+            SpacesConfigParser().read(space)
+            assert False
+        except IncludeError as e:
+            assert "Include cycle" in str(e)
+    finally:
+        shutil.rmtree(library)
     #print config.getprovider('test section 1')
     #print config.getprovider('test section 2')
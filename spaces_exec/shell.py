@@ -0,0 +1,204 @@
+"""
+Long-lived shell co-processes commands are executed in
+
+Commands are written to a bash process's stdin; after each one the shell
+prints a random sentinel with the exit status and the size of the
+command's stderr (collected in a file), then the stderr itself. Nothing is
+spawned per command and outputs are read straight from the pipe.
+
+Since commands run in the co-process and not in the user's shell, the
+exported variables and functions it ends up with are handed back as a
+script (see Shell.changes) for the user's shell to eval. So are a few
+shell variables that are not exported: the prompt, and what an activated
+virtualenv keeps for deactivate.
+"""
+
+import os
+import subprocess
+import tempfile
+import uuid
+
+READ_SIZE = 64 * 1024
+# kept up to date by bash itself, not for changes() to hand over
+SPECIAL_VARIABLES = frozenset(["_", "PWD", "OLDPWD", "SHLVL"])
+# shell variables handed back along with the exported ones
+SHELL_VARIABLES = "PS1 ${!_OLD_VIRTUAL_@}"
+
+
+class ShellError(Exception):
+    pass
+
+
+def parse_declarations(output, prefix):
+    """Split `export -p` / `declare -f` output into name -> declaration"""
+    declarations = {}
+    for chunk in ("\n" + output).split("\n" + prefix)[1:]:
+        chunk = chunk.rstrip("\n")
+        name = chunk.split("=", 1)[0].split(" ", 1)[0].strip()
+        if name:
+            declarations[name] = prefix + chunk
+    return declarations
+
+
+def parse_functions(output):
+    """Split `declare -f` output into name -> declaration; bodies are
+    indented, a function ends with the first "}" line"""
+    functions = {}
+    for chunk in (output.rstrip("\n") + "\n").split("\n}\n"):
+        chunk = chunk.strip("\n")
+        if chunk:
+            functions[chunk.split(" ", 1)[0]] = chunk + "\n}"
+    return functions
+
+
+class Shell(object):
+    """Shell co-process of argv
+
+    Unless initial_state is false the state it starts with is taken right
+    away, for changes() to compare with; that already waits for the shell
+    to answer. seed is a script run before, bringing over state of the
+    user's shell the environment does not carry.
+    """
+    def __init__(self, argv=("bash", "--noprofile", "--norc"),
+                 initial_state=True, seed=None):
+        self._err = tempfile.NamedTemporaryFile(prefix="spaces-err-")
+        self._token = "__SPACES_%s__" % uuid.uuid4().hex
+        self._sentinel = "\n%s " % self._token
+        self.proc = subprocess.Popen(list(argv), stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        self._buffer = bytearray()
+        if seed:
+            self.run(seed)
+        self.initial = self.state() if initial_state else None
+
+    def _read_line(self):
+        while True:
+            end = self._buffer.find("\n")
+            if end >= 0:
+                line = str(self._buffer[:end])
+                del self._buffer[:end + 1]
+                return line
+            self._fill()
+
+    def _read_exactly(self, size):
+        while len(self._buffer) < size:
+            self._fill()
+        data = str(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def _fill(self):
+        data = os.read(self.proc.stdout.fileno(), READ_SIZE)
+        if not data:
+            raise ShellError("Shell exited with %s" % self.proc.wait())
+        self._buffer.extend(data)
+
+    def run(self, cmd):
+        """(status, stdout, stderr) of cmd run in the shell
+
+        Trailing newlines are dropped from outputs, as shell command
+        substitution does it.
+        """
+        err = self._err.name
+        # the command goes through as the body of a quoted here-document
+        # and is eval'd, so whatever bash makes of it the sentinel follows
+        self.proc.stdin.write(
+            "IFS= read -r -d '' __spaces_cmd <<'%s'\n%s\n%s\n"
+            "{ eval \"$__spaces_cmd\"\n} </dev/null 2>%s\n"
+            "__spaces_rc=$?\n"
+            "printf '\\n%s %%d %%d\\n' $__spaces_rc $(wc -c <%s)\n"
+            "cat %s\n" % (self._token, cmd, self._token, err, self._token,
+                          err, err))
+        self.proc.stdin.flush()
+        start = 0
+        while True:
+            pos = self._buffer.find(self._sentinel, start)
+            if pos >= 0:
+                break
+            start = max(0, len(self._buffer) - len(self._sentinel))
+            self._fill()
+        stdout = str(self._buffer[:pos])
+        del self._buffer[:pos + len(self._sentinel)]
+        status, err_size = self._read_line().split()
+        stderr = self._read_exactly(int(err_size))
+        return int(status), stdout.rstrip("\n"), stderr.rstrip("\n")
+
+    def state(self):
+        """Variables (exported and SHELL_VARIABLES) and functions,
+        name -> declaration"""
+        _, exported, _ = self.run("export -p")
+        _, variables, _ = self.run("declare -p %s 2>/dev/null" %
+                                   SHELL_VARIABLES)
+        _, functions, _ = self.run("declare -f")
+        declarations = parse_declarations(exported, "declare -x ")
+        for decl in ("\n" + variables).split("\ndeclare ")[1:]:
+            # the exported ones are there already
+            if decl.startswith("-- "):
+                decl = decl.rstrip("\n")
+                declarations[decl[3:].split("=", 1)[0]] = "declare " + decl
+        return declarations, parse_functions(functions)
+
+    def changes(self, since=None):
+        """Script bringing a shell in state since (default: the state this
+        shell started with) to the current one"""
+        old_vars, old_funcs = since or self.initial
+        new_vars, new_funcs = self.state()
+        old_vars, new_vars = [dict((name, decl)
+                                   for name, decl in variables.iteritems()
+                                   if name not in SPECIAL_VARIABLES)
+                              for variables in (old_vars, new_vars)]
+        # declare would make the variables local when eval'd in a function
+        script = [("export %s" if decl.startswith("declare -x ") else "%s")
+                  % decl[len("declare -x "):]
+                  for name, decl in sorted(new_vars.iteritems())
+                  if old_vars.get(name) != decl]
+        script.extend("unset %s" % name for name in sorted(old_vars)
+                      if name not in new_vars)
+        script.extend(decl for name, decl in sorted(new_funcs.iteritems())
+                      if old_funcs.get(name) != decl)
+        script.extend("unset -f %s" % name for name in sorted(old_funcs)
+                      if name not in new_funcs)
+        return "\n".join(script)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+        self._err.close()
+
+
+if __name__ == "__main__":
+    shell = Shell()
+    assert (0, "hello", "") == shell.run("echo hello")
+    assert (3, "", "oops") == shell.run("echo oops >&2; (exit 3)")
+    assert (0, "a\nb", "") == shell.run("cat <<EOF\na\nb\nEOF")
+    # commands bash cannot parse fail without holding up the shell
+    assert 0 != shell.run("export GREETING=it's")[0]
+    assert "warning" in shell.run("cat <<EOF*.swp\nEOF")[2]
+    assert (0, "ok", "") == shell.run("echo ok")
+    big = shell.run("head -c 3000000 /dev/zero | tr '\\0' x")[1]
+    assert 3000000 == len(big)
+    shell.run("export SPACES_TEST=1; greet() { echo hi; }")
+    assert (0, "1", "") == shell.run("echo $SPACES_TEST")
+    changes = shell.changes()
+    assert 'export SPACES_TEST="1"' in changes
+    assert "greet () \n{ \n    echo hi\n}" in changes
+    shell.run("cd /; unset _")
+    assert "PWD" not in shell.changes() and "unset _" not in shell.changes()
+    shell.close()
+    # the prompt and a virtualenv's saved state make it there and back
+    shell = Shell(seed="declare -- PS1='> '")
+    shell.run("_OLD_VIRTUAL_PS1=$PS1; PS1=\"(venv) $PS1\"")
+    changes = shell.changes().split("\n")
+    assert ['PS1="(venv) > "', '_OLD_VIRTUAL_PS1="> "'] == changes
+    shell.run("PS1=$_OLD_VIRTUAL_PS1; unset _OLD_VIRTUAL_PS1")
+    assert "" == shell.changes()
+    shell.close()
+    # nothing is asked of a shell not taking its initial state
+    shell = Shell(("sh", "-c", "exit 255"), initial_state=False)
+    try:
+        shell.run("true")
+        assert False
+    except (ShellError, IOError):
+        pass
+    shell.close()
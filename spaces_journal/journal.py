@@ -0,0 +1,136 @@
+"""
+Journal of the sections applied to each host
+
+After a provider completes, the fingerprints of the sections it applied
+are written to a JSON file per host, under the space (absolute config
+file path) they belong to, as spaces may have sections of the same name.
+A section whose fingerprint (provider,
+resolved params and fingerprints of the sections it uses) is the one the
+journal has was applied as it is and may be skipped next time. Reverting
+a section takes it out of the journal.
+
+What providers backed up on provide() for revert() (see EnvProvider) is
+kept the same way in a file of its own per host, as --exec runs start
+with new providers every time.
+
+The files are re-read on every access, so daemons and --exec runs on the
+same machine see each other's work.
+"""
+
+import json
+import os
+import sys
+import threading
+
+JOURNAL_DIR = os.path.expanduser("~/.spaces/journal")
+BACKUPS = ".backups"
+
+
+class Journal(object):
+    # shared by all journals of the process, they may be of the same host
+    _lock = threading.Lock()
+
+    def __init__(self, directory=JOURNAL_DIR):
+        self.directory = directory
+
+    def _path(self, host, kind=""):
+        return os.path.join(self.directory,
+                            "%s%s.json" % (host.replace(os.sep, "_"), kind))
+
+    def _load(self, host, kind=""):
+        try:
+            with open(self._path(host, kind)) as f:
+                spaces = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        return spaces if isinstance(spaces, dict) else {}
+
+    def _space(self, spaces, space):
+        applied = spaces.get(space)
+        if not isinstance(applied, dict):
+            applied = spaces[space] = {}
+        return applied
+
+    def _save(self, host, applied, kind=""):
+        path = self._path(host, kind)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(applied, f, indent=1, sort_keys=True)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            print >>sys.stderr, "Cannot write journal %s: %s" % (path, e)
+
+    def applied(self, host, space):
+        """section -> fingerprint of what of space was applied to host"""
+        with self._lock:
+            return self._space(self._load(host), space)
+
+    def record(self, host, space, fingerprints):
+        """Note (section, fingerprint) pairs of space as applied to host"""
+        with self._lock:
+            spaces = self._load(host)
+            self._space(spaces, space).update(fingerprints)
+            self._save(host, spaces)
+
+    def forget(self, host, space, sections):
+        with self._lock:
+            spaces = self._load(host)
+            applied = self._space(spaces, space)
+            for section in sections:
+                applied.pop(section, None)
+            self._save(host, spaces)
+
+    def backups(self, host, space):
+        """section -> what its provider backed up when space was provided
+        on host"""
+        with self._lock:
+            return self._space(self._load(host, BACKUPS), space)
+
+    def keep_backups(self, host, space, backups):
+        """Store (section, backup) pairs of space provided on host; None
+        drops the section's backup"""
+        with self._lock:
+            spaces = self._load(host, BACKUPS)
+            kept = self._space(spaces, space)
+            for section, backup in backups:
+                if backup is None:
+                    kept.pop(section, None)
+                else:
+                    kept[section] = backup
+            self._save(host, spaces, BACKUPS)
+
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        journal = Journal(os.path.join(directory, "journal"))
+        space, other = "/srv/a/spaces.cfg", "/srv/b/spaces.cfg"
+        assert {} == journal.applied("localhost", space)
+        journal.record("localhost", space, [("git", "abc"), ("pkgs", "def")])
+        journal.record("localhost", other, [("git", "xyz")])
+        journal.record("runner-2", space, [("git", "123")])
+        assert {"git": "abc", "pkgs": "def"} == journal.applied(
+            "localhost", space)
+        journal.forget("localhost", space, ["pkgs", "missing"])
+        assert {"git": "abc"} == Journal(journal.directory).applied(
+            "localhost", space)
+        assert {"git": "xyz"} == journal.applied("localhost", other)
+        assert {"git": "123"} == journal.applied("runner-2", space)
+        journal.keep_backups("localhost", space, [("env", {"A": "1"}),
+                                                  ("tools", {})])
+        assert {"env": {"A": "1"}, "tools": {}} == journal.backups(
+            "localhost", space)
+        journal.keep_backups("localhost", space, [("env", None)])
+        assert {"tools": {}} == journal.backups("localhost", space)
+        assert {"git": "abc"} == journal.applied("localhost", space)
+        # files written before entries were kept per space
+        with open(journal._path("old"), "w") as f:
+            json.dump({"git": "abc"}, f)
+        assert {} == journal.applied("old", space)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,164 @@
+"""
+Framed wire protocol between the spaces daemon and its clients
+
+Every message is a sequence of frames terminated with an EOM frame. A frame
+is a header line with its name and payload length followed by exactly that
+many bytes of payload:
+
+    CMD 16\n
+    which virtualenvSLOT 1\n
+    0EOM 0\n
+
+Payloads are never scanned or split, so outputs of any size go through
+with a single copy and may contain newlines. STDOUT and STDERR payloads
+larger than SPOOL_SIZE are not held in memory: they are copied in chunks
+to a spooled temporary file and handed over as an Output, read back line
+by line. A connection stays open for as many messages as the session
+needs.
+
+Client -> daemon: PROVIDE or REVERT (empty payload), or for every executed
+command the frames SLOT, STATUS, STDOUT and STDERR. Optionally preceded by
+SESSION <token>; clients keep the token between connections so that a
+REVERT reaches the session that provided. PROVIDE and REVERT may be followed by HOST <name> when
+the client is not on the daemon's host, by SPACE <config file> to name
+the space (the daemon's default one otherwise; a connection stays with
+its space until it names another), and PROVIDE by FORCE to re-apply the
+sections the host's journal has as applied. STATS asks for the daemon's
+space cache statistics.
+
+Daemon -> client: SESSION <token>, then SLOT/DESC/CMD for every command to
+run, or one of WAIT (other slots still running), END, ERROR. STATS is
+answered with STATS <JSON>.
+"""
+
+import tempfile
+
+EOM = "EOM"
+SPOOL_SIZE = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+# frames whose payloads may be large command outputs
+STREAMED = ("STDOUT", "STDERR")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class Output(object):
+    """Command output too large to be kept in memory
+
+    Iterating gives its lines without line endings, read lazily from the
+    spool; every iteration starts over, so it can be read more than once
+    (facts cache). str() loads it all and should be left to small outputs.
+    """
+    def __init__(self, spool_size=SPOOL_SIZE):
+        self._file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self._size = 0
+
+    def write(self, data):
+        self._file.seek(0, 2)
+        self._file.write(data)
+        self._size += len(data)
+
+    def __len__(self):
+        return self._size
+
+    def chunks(self):
+        """The output as it was written, in chunks of at most CHUNK_SIZE"""
+        offset = 0
+        while offset < self._size:
+            self._file.seek(offset)
+            chunk = self._file.read(CHUNK_SIZE)
+            offset += len(chunk)
+            yield chunk
+
+    def __iter__(self):
+        rest = ""
+        for chunk in self.chunks():
+            lines = (rest + chunk).split("\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line
+        if rest:
+            yield rest
+
+    def __str__(self):
+        self._file.seek(0)
+        return self._file.read()
+
+    def close(self):
+        self._file.close()
+
+
+def write_frame(wfile, name, payload=""):
+    wfile.write("%s %d\n" % (name, len(payload)))
+    if isinstance(payload, Output):
+        for chunk in payload.chunks():
+            wfile.write(chunk)
+    elif payload:
+        wfile.write(payload)
+
+
+def write_message(wfile, frames):
+    for name, payload in frames:
+        write_frame(wfile, name, payload)
+    write_frame(wfile, EOM)
+    wfile.flush()
+
+
+def read_frame(rfile):
+    header = rfile.readline()
+    if not header:
+        raise EOFError
+    try:
+        name, length = header.split(" ")
+        length = int(length)
+    except ValueError:
+        raise ProtocolError("Malformed frame header: %r" % header)
+    if name in STREAMED and length > SPOOL_SIZE:
+        payload = Output()
+        while len(payload) < length:
+            chunk = rfile.read(min(CHUNK_SIZE, length - len(payload)))
+            if not chunk:
+                break
+            payload.write(chunk)
+    else:
+        payload = rfile.read(length) if length else ""
+    if len(payload) != length:
+        raise ProtocolError("Frame %s truncated" % name)
+    return name, payload
+
+
+def read_message(rfile):
+    """Read frames up to EOM; returns list of (name, payload)"""
+    frames = []
+    while True:
+        name, payload = read_frame(rfile)
+        if name == EOM:
+            return frames
+        frames.append((name, payload))
+
+
+if __name__ == "__main__":
+    from StringIO import StringIO
+    big = "".join("pkg%d==1.%d\n" % (i, i) for i in xrange(20000))
+    wire = StringIO()
+    write_message(wire, [("SLOT", "0"), ("STATUS", "0"), ("STDOUT", big),
+                         ("STDERR", "")])
+    wire.seek(0)
+    frames = read_message(wire)
+    assert [("SLOT", "0"), ("STATUS", "0")] == frames[:2]
+    stdout = frames[2][1]
+    assert isinstance(stdout, Output) and len(big) == len(stdout)
+    assert "pkg0==1.0" == iter(stdout).next()
+    assert 20000 == sum(1 for _ in stdout) == sum(1 for _ in stdout)
+    assert big == str(stdout)
+    assert ("STDERR", "") == frames[3]
+    # streamed outputs go out as they came, final newline or not
+    unterminated = Output()
+    unterminated.write("a\nb")
+    wire = StringIO()
+    write_message(wire, [("STDOUT", unterminated), ("STDOUT", stdout)])
+    assert wire.getvalue().startswith("STDOUT 3\na\nbSTDOUT %d\n" % len(big))
+    wire.seek(0)
+    assert big == str(read_message(wire)[1][1])
@@ -0,0 +1,108 @@
+"""
+Timing of provisioning runs
+
+A Tracer collects complete ("X") events in Chrome trace format: one lane
+per provider slot plus a session lane for round trips. Categories:
+    provider: a provider generator from its first command to its end
+    generator: time spent inside a generator, i.e. on the daemon
+    command: a command from being handed out to its result coming back,
+             i.e. on the client and the wire
+    roundtrip: a whole message exchange with the client
+
+export() writes a file chrome://tracing and Perfetto can open; summary()
+aggregates the same events per provider class.
+"""
+
+import json
+import threading
+import time
+
+SESSION_LANE = 0
+
+
+class Tracer(object):
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.origin = clock()
+        self.events = []
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def _us(self, timestamp):
+        return int((timestamp - self.origin) * 1e6)
+
+    def complete(self, name, cat, lane, start, end, **args):
+        event = dict(name=name, cat=cat, ph="X", pid=1, tid=lane,
+                     ts=self._us(start), dur=self._us(end) - self._us(start),
+                     args=args)
+        with self._lock:
+            self.events.append(event)
+
+    def begin(self, key, name, cat, lane, **args):
+        self._open[key] = (name, cat, lane, self.clock(), args)
+
+    def end(self, key, **args):
+        try:
+            name, cat, lane, start, begin_args = self._open.pop(key)
+        except KeyError:
+            return
+        begin_args.update(args)
+        self.complete(name, cat, lane, start, self.clock(), **begin_args)
+
+    def summary(self):
+        """Totals per provider class: providers run, wall time, daemon
+        (generator) time, client (command) time, commands and bytes"""
+        stats = {}
+        for event in self.events:
+            provider = event['args'].get('provider')
+            if provider is None:
+                continue
+            entry = stats.setdefault(provider, dict(
+                providers=0, wall=0.0, generator=0.0, client=0.0,
+                commands=0, bytes_out=0, bytes_in=0))
+            seconds = event['dur'] / 1e6
+            if event['cat'] == 'provider':
+                entry['providers'] += 1
+                entry['wall'] += seconds
+            elif event['cat'] == 'generator':
+                entry['generator'] += seconds
+            elif event['cat'] == 'command':
+                entry['client'] += seconds
+                entry['commands'] += 1
+                entry['bytes_out'] += event['args'].get('bytes_out', 0)
+                entry['bytes_in'] += event['args'].get('bytes_in', 0)
+        return stats
+
+    def format_summary(self):
+        lines = ["%-20s %5s %9s %9s %9s %6s %10s" % (
+            "provider", "runs", "wall", "daemon", "client", "cmds",
+            "bytes in")]
+        for provider, entry in sorted(self.summary().iteritems()):
+            lines.append("%-20s %5d %8.3fs %8.3fs %8.3fs %6d %10d" % (
+                provider, entry['providers'], entry['wall'],
+                entry['generator'], entry['client'], entry['commands'],
+                entry['bytes_in']))
+        return "\n".join(lines)
+
+    def export(self, path):
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit="ms",
+                           summary=self.summary()), f)
+
+
+if __name__ == "__main__":
+    now = [100.0]
+    tracer = Tracer(clock=lambda: now[0])
+    tracer.begin('p', "EnvProvider", 'provider', 1, provider="EnvProvider")
+    tracer.complete("env", 'command', 1, 100.0, 100.5,
+                    provider="EnvProvider", bytes_out=3, bytes_in=120)
+    tracer.complete("env", 'generator', 1, 100.5, 100.75,
+                    provider="EnvProvider")
+    now[0] = 101.0
+    tracer.end('p')
+    stats = tracer.summary()['EnvProvider']
+    assert 1 == stats['providers'] and 1.0 == stats['wall']
+    assert 0.5 == stats['client'] and 0.25 == stats['generator']
+    assert 120 == stats['bytes_in']